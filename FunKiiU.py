@@ -4,21 +4,60 @@ __VERSION__ = "2.2"
 
 import base64
 import binascii
+import codecs
+import contextvars
+import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import queue
+import random
 import re
+import shutil
 import socket
+import struct
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import zlib
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from http.client import RemoteDisconnected
-from typing import Iterator, MutableSequence, Optional, Tuple
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from functools import partial
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection, RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableSequence,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 from unidecode import unidecode
 
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None  # type: ignore
+
 SIZE_UNITS = ("B", "KB", "MB", "GB", "T", "P", "E", "Z", "Y")
+SIZE_PREFIXES = tuple(reversed([(s, 1 << (i + 1) * 10) for i, s in enumerate(SIZE_UNITS[1:])]))
 MAGIC = binascii.a2b_hex(
     "00010003704138EFBBBDA16A987DD901326D1C9459484C88A2861B91A312587AE70EF6237EC50E1032DC39DDE89A96A8E859D76A98A6E7E36A0CFE352CA893058234FF833FCB3B03811E9F0DC0D9A52F8045B4B2F9411B67A51C44B5EF8CE77BD6D56BA75734A1856DE6D4BED6D3A242C7C8791B3422375E5C779ABF072F7695EFA0F75BCB83789FC30E3FE4CC8392207840638949C7F688565F649B74D63D8D58FFADDA571E9554426B1318FC468983D4C8A5628B06B6FC5D507C13E7A18AC1511EB6D62EA5448F83501447A9AFB3ECC2903C9DD52F922AC9ACDBEF58C6021848D96E208732D3D1D9D9EA440D91621C7A99DB8843C59C1F2E2C7D9B577D512C166D6F7E1AAD4A774A37447E78FE2021E14A95D112A068ADA019F463C7A55685AABB6888B9246483D18B9C806F474918331782344A4B8531334B26303263D9D2EB4F4BB99602B352F6AE4046C69A5E7E8E4A18EF9BC0A2DED61310417012FD824CC116CFB7C4C1F7EC7177A17446CBDE96F3EDD88FCD052F0B888A45FDAF2B631354F40D16E5FA9C2C4EDA98E798D15E6046DC5363F3096B2C607A9D8DD55B1502A6AC7D3CC8D8C575998E7D796910C804C495235057E91ECD2637C9C1845151AC6B9A0490AE3EC6F47740A0DB0BA36D075956CEE7354EA3E9A4F2720B26550C7D394324BC0CB7E9317D8A8661F42191FF10B08256CE3FD25B745E5194906B4D61CB4C2E000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000526F6F7400000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000001434130303030303030330000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000007BE8EF6CB279C9E2EEE121C6EAF44FF639F88F078B4B77ED9F9560B0358281B50E55AB721115A177703C7A30FE3AE9EF1C60BC1D974676B23A68CC04B198525BC968F11DE2DB50E4D9E7F071E562DAE2092233E9D363F61DD7C19FF3A4A91E8F6553D471DD7B84B9F1B8CE7335F0F5540563A1EAB83963E09BE901011F99546361287020E9CC0DAB487F140D6626A1836D27111F2068DE4772149151CF69C61BA60EF9D949A0F71F5499F2D39AD28C7005348293C431FFBD33F6BCA60DC7195EA2BCC56D200BAF6D06D09C41DB8DE9C720154CA4832B69C08C69CD3B073A0063602F462D338061A5EA6C915CD5623579C3EB64CE44EF586D14BAAA8834019B3EEBEED3790001000100000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000100042EA66C66CFF335797D0497B77A197F9FE51AB5A41375DC73FD9E0B10669B1B9A5B7E8AB28F01B67B6254C14AA1331418F25BA549004C378DD72F0CE63B1F7091AAFE3809B7AC6C2876A61D60516C43A63729162D280BE21BE8E2FE057D8EB6E204242245731AB6FEE30E5335373EEBA970D531BBA2CB222D9684387D5F2A1BF75200CE0656E390CE19135B59E14F0FA5C1281A7386CCD1C8EC3FAD70FBCE74DEEE1FD05F46330B51F9B79E1DDBF4E33F14889D05282924C5F5DC2766EF0627D7EEDC736E67C2E5B93834668072216D1C78B823A072D34FF3ECF9BD11A29AF16C33BD09AFB2D74D534E027C19240D595A68EBB305ACC44AB38AB820C6D426560C000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000526F6F742D43413030303030303033000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000143503030303030303062000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000137A080BA689C590FD0B2F0D4F56B632FB934ED0739517B33A79DE040EE92DC31D37C7F73BF04BD3E44E20AB5A6FEAF5984CC1F6062E9A9FE56C3285DC6F25DDD5D0BF9FE2EFE835DF2634ED937FAB0214D104809CF74B860E6B0483F4CD2DAB2A9602BC56F0D6BD946AED6E0BE4F08F26686BD09EF7DB325F82B18F6AF2ED525BFD828B653FEE6ECE400D5A48FFE22D538BB5335B4153342D4335ACF590D0D30AE2043C7F5AD214FC9C0FE6FA40A5C86506CA6369BCEE44A32D9E695CF00B4FD79ADB568D149C2028A14C9D71B850CA365B37F70B657791FC5D728C4E18FD22557C4062D74771533C70179D3DAE8F92B117E45CB332F3B3C2A22E705CFEC66F6DA3772B000100010000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000010004919EBE464AD0F552CD1B72E7884910CF55A9F02E50789641D896683DC005BD0AEA87079D8AC284C675065F74C8BF37C88044409502A022980BB8AD48383F6D28A79DE39626CCB2B22A0F19E41032F094B39FF0133146DEC8F6C1A9D55CD28D9E1C47B3D11F4F5426C2C780135A2775D3CA679BC7E834F0E0FB58E68860A71330FC95791793C8FBA935A7A6908F229DEE2A0CA6B9B23B12D495A6FE19D0D72648216878605A66538DBF376899905D3445FC5C727A0E13E0E2C8971C9CFA6C60678875732A4E75523D2F562F12AABD1573BF06C94054AEFA81A71417AF9A4A066D0FFC5AD64BAB28B1FF60661F4437D49E1E0D9412EB4BCACF4CFD6A3408847982000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000526F6F742D43413030303030303033000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000158533030303030303063000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000137A0894AD505BB6C67E2E5BDD6A3BEC43D910C772E9CC290DA58588B77DCC11680BB3E29F4EABBB26E98C2601985C041BB14378E689181AAD770568E928A2B98167EE3E10D072BEEF1FA22FA2AA3E13F11E1836A92A4281EF70AAF4E462998221C6FBB9BDD017E6AC590494E9CEA9859CEB2D2A4C1766F2C33912C58F14A803E36FCCDCCCDC13FD7AE77C7A78D997E6ACC35557E0D3E9EB64B43C92F4C50D67A602DEB391B06661CD32880BD64912AF1CBCB7162A06F02565D3B0ECE4FCECDDAE8A4934DB8EE67F3017986221155D131C6C3F09AB1945C206AC70C942B36F49A1183BCD78B6E4B47C6C5CAC0F8D62F897C6953DD12F28B70C5B7DF751819A98346526250001000100000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000"
 )
@@ -26,13 +65,40 @@ TIKTEM = binascii.a2b_hex(
     "00010004d15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11ad15ea5ed15abe11a000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000526f6f742d434130303030303030332d585330303030303030630000000000000000000000000000000000000000000000000000000000000000000000000000feedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedfacefeedface010000cccccccccccccccccccccccccccccccc00000000000000000000000000aaaaaaaaaaaaaaaa00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000010000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000010014000000ac000000140001001400000000000000280000000100000084000000840003000000000000ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000"
 )
 TK = 0x140
+CONTENT_TYPE_HASHED = 0x0002
+TMD_CONTENTS_OFFSET = 0xB04
+TMD_CONTENT_RECORD = struct.Struct(">4sHHQ20s12x")
 ALL_REGIONS = {"ALL", "EUR", "USA", "JPN"}
 DOWNLOAD_TYPES = {"0000", "000c", "000e"}
+DEFAULT_CDN = "http://ccs.cdn.c.shop.nintendowifi.net/ccs/download"
 USER_AGENT_HEADER = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:102.0) Gecko/20100101 Firefox/102.0"
-DEFAULT_TIMEOUT = 120
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+MIN_READ_TIMEOUT = 10.0
+DEFAULT_RETRY_BACKOFF = 1.0
+MAX_RETRY_BACKOFF = 60.0
+DEFAULT_STALL_SPEED = 2**10
+DEFAULT_STALL_TIME = 30.0
+DEFAULT_BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_IDLE_TIMEOUT = 30.0
+MAX_REDIRECTS = 5
+DEFAULT_SEGMENTS = 4
+DEFAULT_SEGMENT_THRESHOLD = 256 * 2**20
+MAX_CHUNK_SIZE = 2**20
+PROGRESS_INTERVAL = 0.25
+QUEUE_ORDERS = ("fifo", "smallest", "largest", "priority")
+PLAN_JOBS = 8  # TMDs fetched at the same time while planning, they are small
+THROUGHPUT_WINDOW = 10.0
 
 RE_16_HEX = re.compile(r"^[0-9a-f]{16}$", re.IGNORECASE)
 RE_32_HEX = re.compile(r"^[0-9a-f]{32}$", re.IGNORECASE)
+FICLONE = 0x40049409  # Linux ioctl making a file share the blocks of another one
+RE_HUMAN_SIZE = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMGTPEZY]B?|B)?$", re.IGNORECASE)
+RE_CONTENT_RANGE = re.compile(r"^bytes (\d+)-\d+/(?:\d+|\*)$")
+RE_JSON_SPACE = re.compile(r"[ \t\n\r]*")
+RE_TITLE_DIR = re.compile(r"([0-9A-Fa-f]{16})(?:_DLC|_Update)?$")
 
 check_title_id = RE_16_HEX.match
 check_title_key = RE_32_HEX.match
@@ -46,21 +112,187 @@ def bytes2human(n: int, f: str = "%(value).2f %(symbol)s") -> str:
     n = int(n)
     if n < 0:
         raise ValueError("n < 0")
-    prefix = {}
-    for i, s in enumerate(SIZE_UNITS[1:]):
-        prefix[s] = 1 << (i + 1) * 10
-    for symbol in reversed(SIZE_UNITS[1:]):
-        if n >= prefix[symbol]:
-            value = float(n) / prefix[symbol]
+    for symbol, prefix in SIZE_PREFIXES:
+        if n >= prefix:
+            value = float(n) / prefix
             return f % locals()
     return f % dict(symbol=SIZE_UNITS[0], value=n)
 
 
-def retry(count: int) -> Iterator[int]:
-    for i in range(1, count + 1):
-        if i > 1:
-            print(f"*Attempt {i} of {count}")
-        yield i
+def seconds2human(seconds: float) -> str:
+    """
+    >>> seconds2human(42)
+    '42s'
+    >>> seconds2human(3725)
+    '1h02m05s'
+    """
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{secs:02d}s"
+    if minutes:
+        return f"{minutes}m{secs:02d}s"
+    return f"{secs}s"
+
+
+def human2bytes(s: str) -> int:
+    """
+    >>> human2bytes("512")
+    512
+    >>> human2bytes("1.5K")
+    1536
+    >>> human2bytes("256MB")
+    268435456
+    """
+    match = RE_HUMAN_SIZE.match(s.strip())
+    if not match:
+        raise ValueError(f"invalid size {s!r}")
+    value, symbol = match.groups()
+    if not symbol:
+        return int(float(value))
+    symbol = symbol.upper()
+    exponent = next(i for i, unit in enumerate(SIZE_UNITS) if unit[0] == symbol[0])
+    return int(float(value) * (1 << exponent * 10))
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds asked for by a `Retry-After` header, given as seconds or as a date.
+
+    >>> retry_after("120")
+    120.0
+    >>> retry_after("Thu, 01 Jan 1970 00:00:00 GMT")
+    0.0
+    >>> retry_after("soon")
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostHealth:
+    __slots__ = ("failures", "paused_until", "ttfb")
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self.paused_until = 0.0
+        self.ttfb: Optional[float] = None
+
+
+class RetryPolicy:
+    """When failed downloads are retried, and how long a slow server is waited for.
+
+    Attempt `n` waits a random time of up to `backoff * 2 ** (n - 2)` seconds, at most
+    `MAX_RETRY_BACKOFF`. Connections get `connect_timeout` seconds to be made; reads get a
+    timeout adapted to the response times seen from the host, between `MIN_READ_TIMEOUT`
+    and `read_timeout`. A stream slower than `stall_speed` bytes per second for
+    `stall_time` seconds is aborted so it can be resumed (0 never aborts). After
+    `breaker_threshold` failures in a row, or when a host asks for it with `Retry-After`,
+    every download from that host pauses instead of wasting its attempts (0 never pauses).
+    """
+
+    def __init__(
+        self,
+        backoff: float = DEFAULT_RETRY_BACKOFF,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        stall_speed: int = DEFAULT_STALL_SPEED,
+        stall_time: float = DEFAULT_STALL_TIME,
+        breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+    ) -> None:
+        self.backoff = backoff
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stall_speed = stall_speed
+        self.stall_time = stall_time
+        self.breaker_threshold = breaker_threshold
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, HostHealth] = {}
+
+    def _host(self, host: str) -> HostHealth:
+        health = self._hosts.get(host)
+        if health is None:
+            health = self._hosts[host] = HostHealth()
+        return health
+
+    def delay(self, attempt: int) -> float:
+        if attempt < 2 or not self.backoff:
+            return 0.0
+        return random.uniform(0, min(MAX_RETRY_BACKOFF, self.backoff * 2 ** (attempt - 2)))
+
+    def timeout_for(self, host: str) -> float:
+        with self._lock:
+            ttfb = self._host(host).ttfb
+        if ttfb is None:
+            return self.read_timeout
+        return min(self.read_timeout, max(MIN_READ_TIMEOUT, 8 * ttfb))
+
+    def responded(self, host: str, ttfb: float) -> None:
+        with self._lock:
+            health = self._host(host)
+            health.ttfb = ttfb if health.ttfb is None else 0.8 * health.ttfb + 0.2 * ttfb
+
+    def succeeded(self, host: Optional[str]) -> None:
+        with self._lock:
+            self._host(host or "").failures = 0
+
+    def failed(self, host: Optional[str], error: Exception) -> None:
+        """Counts a failure of the host itself; missing files and bad data don't count."""
+        if isinstance(error, HTTPError) and error.code != 429 and error.code < 500:
+            return
+        with self._lock:
+            health = self._host(host or "")
+            health.failures += 1
+            if isinstance(error, socket.timeout) and health.ttfb is not None:
+                # give a host that timed out more time on the next attempts
+                health.ttfb *= 2
+            pause = retry_after(error.headers.get("Retry-After")) if isinstance(error, HTTPError) else None
+            if pause is None and self.breaker_threshold and health.failures >= self.breaker_threshold:
+                pause = BREAKER_COOLDOWN
+            if pause:
+                health.paused_until = max(health.paused_until, time.monotonic() + min(pause, MAX_RETRY_BACKOFF))
+
+    def wait(self, host: Optional[str]) -> None:
+        """Blocks while downloads from `host` are paused."""
+        with self._lock:
+            paused_until = self._host(host or "").paused_until
+        delay = paused_until - time.monotonic()
+        if delay > 0:
+            log(f"*{host} is failing, waiting {seconds2human(delay)} before trying it again")
+            time.sleep(delay)
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def retry(count: int, url: Optional[str] = None, progress: Optional[Callable[[], int]] = None) -> Iterator[int]:
+    """Attempt numbers until `count` attempts failed, waiting between attempts as `RETRY_POLICY` says.
+
+    An attempt that leaves `progress()` higher than ever before, like a download that got further
+    before its connection dropped, doesn't count as failed and is followed by the next one right away.
+    """
+    host = urlsplit(url).hostname if url else None
+    best = progress() if progress else 0
+    failed = 0
+    for attempt in itertools.count(1):
+        if attempt > 1:
+            done = progress() if progress else 0
+            if done > best:
+                best = done
+                log("*Continuing where the last attempt stopped")
+            else:
+                failed += 1
+                if failed >= count:
+                    return
+                time.sleep(RETRY_POLICY.delay(failed + 1))
+                log(f"*Attempt {failed + 1} of {count}")
+        if host:
+            RETRY_POLICY.wait(host)
+        yield attempt
 
 
 def progress_bar(
@@ -73,6 +305,922 @@ def progress_bar(
     return f"{left}{bar}{blanks}{right} {bytes2human(part)} of {bytes2human(total)}, {percent}%" + " " * 20
 
 
+class Progress:
+    """Single status line shared by every download in flight.
+
+    Log lines are written through `write` so they never get mixed with the status line. The
+    status line is redrawn at most every `PROGRESS_INTERVAL` seconds, and only on a terminal.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._files: Dict[str, List[int]] = {}
+        self._shown = False
+        self._next_render = 0.0
+        self.enabled = bool(sys.stdout and sys.stdout.isatty())
+
+    def start(self, name: str, total: int, part: int = 0) -> None:
+        with self._lock:
+            self._files[name] = [part, total]
+
+    def advance(self, name: str, size: int) -> None:
+        with self._lock:
+            self._files[name][0] += size
+            if not self.enabled:
+                return
+            now = time.monotonic()
+            if now >= self._next_render:
+                self._next_render = now + PROGRESS_INTERVAL
+                self._render()
+
+    def finish(self, name: str) -> None:
+        with self._lock:
+            self._files.pop(name, None)
+            self._clear()
+
+    def show(self, line: str) -> None:
+        """Shows a status line that isn't made of files in flight, like the one of a daemon."""
+        with self._lock:
+            if self.enabled:
+                self._clear()
+                print(line, end="\r", flush=True)
+                self._shown = True
+
+    def write(self, text: str) -> None:
+        with self._lock:
+            self._clear()
+            print(text)
+            self._render()
+
+    def _clear(self) -> None:
+        if self._shown:
+            print(" " * 150, end="\r")
+            self._shown = False
+
+    def _render(self) -> None:
+        if not self._files or not self.enabled:
+            return
+        if len(self._files) == 1:
+            ((part, total),) = self._files.values()
+            line = f" Downloaded {progress_bar(part, total)}"
+        else:
+            part = sum(p for p, _ in self._files.values())
+            total = sum(t for _, t in self._files.values())
+            line = f" Downloading {len(self._files)} files: {progress_bar(part, total)}"
+        if SCHEDULER.planned:
+            line = f"{line.rstrip()} | {SCHEDULER.summary()}"
+        print(line, end="\r", flush=True)
+        self._shown = True
+
+
+PROGRESS = Progress()
+
+
+class Scheduler:
+    """Global view of the content bytes of a run: rate limiting, throughput and ETA.
+
+    Every byte read from the network goes through `transferred`, which also enforces the
+    `max_rate` token bucket (in bytes per second, 0 for no limit). Content bytes are planned
+    once a TMD is read; bytes found on disk count as skipped instead of transferred.
+    """
+
+    def __init__(self, max_rate: int = 0) -> None:
+        self.max_rate = max_rate
+        self.planned = 0
+        self.done = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._tokens = float(max_rate)
+        self._refilled = time.monotonic()
+        self._started = time.monotonic()
+        self._samples: Deque[Tuple[float, int]] = deque()
+
+    def plan(self, size: int) -> None:
+        with self._lock:
+            self.planned += size
+
+    def skip(self, size: int) -> None:
+        with self._lock:
+            self.skipped += size
+
+    def transferred(self, size: int, planned: bool = True) -> float:
+        """Counts `size` bytes read, sleeping as long as the rate limit needs; returns the time slept."""
+        delay = 0.0
+        with self._lock:
+            if planned:
+                self.done += size
+            if self.max_rate:
+                now = time.monotonic()
+                self._tokens = min(float(self.max_rate), self._tokens + (now - self._refilled) * self.max_rate)
+                self._refilled = now
+                self._tokens -= size
+                if self._tokens < 0:
+                    delay = -self._tokens / self.max_rate
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.planned - self.done - self.skipped)
+
+    def throughput(self) -> float:
+        """Bytes per second over the last `THROUGHPUT_WINDOW` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, self.done))
+            while len(self._samples) > 2 and now - self._samples[0][0] > THROUGHPUT_WINDOW:
+                self._samples.popleft()
+            start, start_done = self._samples[0]
+            return (self.done - start_done) / (now - start) if now > start else 0.0
+
+    def summary(self) -> str:
+        rate = self.throughput()
+        eta = seconds2human(self.remaining / rate) if rate else "?"
+        return f"{bytes2human(int(rate))}/s, {bytes2human(self.remaining)} left, ETA {eta}"
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self._started
+        average = self.done / elapsed if elapsed else 0.0
+        return (
+            f"Downloaded {bytes2human(self.done)} in {seconds2human(elapsed)} ({bytes2human(int(average))}/s), "
+            f"{bytes2human(self.skipped)} already on disk"
+        )
+
+
+SCHEDULER = Scheduler()
+
+
+CURRENT_TITLE: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("CURRENT_TITLE", default=None)
+# where `log` sends its lines instead of the terminal, such as the client of a daemon job
+LOG_SINK: contextvars.ContextVar[Optional[Callable[[str], None]]] = contextvars.ContextVar("LOG_SINK", default=None)
+
+
+class Metrics:
+    """Structured events of a run, aggregated per title and per host.
+
+    Events are emitted per file attempt and per title, never from the read loop, and
+    nothing is recorded at all unless an event log, a Prometheus file or stats are asked for.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events_file: Optional[Any] = None
+        self.titles: Dict[str, Dict[str, Any]] = {}
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, events_fname: Optional[str] = None, stats: bool = False, prometheus: bool = False) -> None:
+        self.enabled = bool(events_fname or stats or prometheus)
+        if events_fname:
+            self._events_file = open(events_fname, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+
+    def emit(self, event: str, **fields: Any) -> None:
+        if not self.enabled:
+            return
+        record = {"time": round(time.time(), 3), "event": event, "title": CURRENT_TITLE.get(), **fields}
+        with self._lock:
+            if event == "file":
+                self._add_file(record)
+            elif event == "title" and record["title"]:
+                self._title(record["title"])["result"] = record["result"]
+            if self._events_file is not None:
+                self._events_file.write(json.dumps(record) + "\n")
+                self._events_file.flush()
+
+    def _title(self, title_id: str) -> Dict[str, Any]:
+        return self.titles.setdefault(
+            title_id, {"files": 0, "bytes": 0, "seconds": 0.0, "retries": 0, "skipped": 0, "result": None}
+        )
+
+    def _add_file(self, record: Dict[str, Any]) -> None:
+        host = self.hosts.setdefault(
+            record["host"],
+            {"requests": 0, "bytes": 0, "seconds": 0.0, "errors": 0, "retries": 0, "ttfb": 0.0, "ttfb_count": 0},
+        )
+        retried = record["attempt"] > 1
+        if record.get("status") is not None or record["result"] == "error":
+            host["requests"] += 1
+        host["bytes"] += record["bytes"]
+        host["seconds"] += record["seconds"]
+        host["errors"] += record["result"] not in ("ok", "not_found")
+        host["retries"] += retried
+        if record.get("ttfb") is not None:
+            host["ttfb"] += record["ttfb"]
+            host["ttfb_count"] += 1
+        if record["title"]:
+            title = self._title(record["title"])
+            title["files"] += record["result"] == "ok"
+            title["bytes"] += record["bytes"]
+            title["seconds"] += record["seconds"]
+            title["retries"] += retried
+            title["skipped"] += record["decision"] in ("skip", "verified", "journal")
+
+    def stats_table(self) -> str:
+        lines = [f"{'Title':<18}{'Result':<14}{'Files':>7}{'Skipped':>9}{'Retries':>9}{'Bytes':>12}{'Speed':>12}"]
+        for title_id, title in sorted(self.titles.items()):
+            speed = title["bytes"] / title["seconds"] if title["seconds"] else 0
+            lines.append(
+                f"{title_id:<18}{title['result'] or '-':<14}{title['files']:>7}{title['skipped']:>9}"
+                f"{title['retries']:>9}{bytes2human(title['bytes']):>12}{bytes2human(int(speed)) + '/s':>12}"
+            )
+        lines.append("")
+        lines.append(f"{'Host':<40}{'Requests':>9}{'Errors':>8}{'Retries':>9}{'Bytes':>12}{'Speed':>12}{'TTFB':>9}")
+        for name, host in sorted(self.hosts.items()):
+            speed = host["bytes"] / host["seconds"] if host["seconds"] else 0
+            ttfb = f"{host['ttfb'] / host['ttfb_count'] * 1000:.0f}ms" if host["ttfb_count"] else "-"
+            lines.append(
+                f"{name:<40}{host['requests']:>9}{host['errors']:>8}{host['retries']:>9}"
+                f"{bytes2human(host['bytes']):>12}{bytes2human(int(speed)) + '/s':>12}{ttfb:>9}"
+            )
+        return "\n".join(lines)
+
+    def write_prometheus(self, fname: str) -> None:
+        """Writes the totals in the Prometheus textfile collector format."""
+        lines = []
+        for metric, kind, help_text, key in (
+            ("funkiiu_requests_total", "counter", "HTTP requests sent", "requests"),
+            ("funkiiu_errors_total", "counter", "Failed download attempts", "errors"),
+            ("funkiiu_retries_total", "counter", "Download attempts after the first one", "retries"),
+            ("funkiiu_downloaded_bytes_total", "counter", "Bytes downloaded", "bytes"),
+            ("funkiiu_download_seconds_total", "counter", "Seconds spent downloading", "seconds"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, host in sorted(self.hosts.items()):
+                lines.append(f'{metric}{{host="{name}"}} {host[key]}')
+        # the sum and count of a summary are one metric family
+        lines.append("# HELP funkiiu_ttfb_seconds Time to first byte of the responses")
+        lines.append("# TYPE funkiiu_ttfb_seconds summary")
+        for name, host in sorted(self.hosts.items()):
+            lines.append(f'funkiiu_ttfb_seconds_sum{{host="{name}"}} {host["ttfb"]}')
+            lines.append(f'funkiiu_ttfb_seconds_count{{host="{name}"}} {host["ttfb_count"]}')
+        results: Dict[str, int] = {}
+        for title in self.titles.values():
+            results[title["result"] or "unknown"] = results.get(title["result"] or "unknown", 0) + 1
+        lines.append("# HELP funkiiu_titles_total Titles worked on, by result")
+        lines.append("# TYPE funkiiu_titles_total counter")
+        for result, count in sorted(results.items()):
+            lines.append(f'funkiiu_titles_total{{result="{result}"}} {count}')
+        with open(fname + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(fname + ".tmp", fname)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._events_file is not None:
+                self._events_file.close()
+                self._events_file = None
+
+
+METRICS = Metrics()
+
+
+class PriorityExecutor:
+    """Thread pool that runs the queued call with the lowest priority first."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str) -> None:
+        self._queue: "queue.PriorityQueue[Tuple[Tuple[Any, ...], int, Any, Any]]" = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{thread_name_prefix}_{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, priority: Tuple[Any, ...], fn: Callable[[], Any]) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._stopped:
+                future.cancel()
+                future.set_running_or_notify_cancel()
+                return future
+            # the call runs in the context of the caller, see CURRENT_TITLE
+            self._queue.put((priority, next(self._sequence), future, partial(contextvars.copy_context().run, fn)))
+        return future
+
+    def _work(self) -> None:
+        while True:
+            _, _, future, fn = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        with self._lock:
+            if cancel_futures:
+                # the stop markers come after every queued call, so the queued calls are dropped first
+                while True:
+                    try:
+                        _, _, future, _ = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if future is not None:
+                        # wakes up whoever waits for it, like a cancelled call of a ThreadPoolExecutor
+                        future.cancel()
+                        future.set_running_or_notify_cancel()
+            if not self._stopped:
+                self._stopped = True
+                for _ in self._threads:
+                    self._queue.put(((float("inf"),), next(self._sequence), None, None))
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def collect(futures: List[Future]) -> List[Any]:
+    """Results of `futures` in order, cancelling the ones not yet started when one of them can't be had."""
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+class DownloadEngine:
+    """Worker pools for downloading titles and their contents concurrently.
+
+    `jobs` bounds both the number of titles worked on at once and the number of
+    content downloads in flight overall; `per_title_jobs` bounds the latter per title.
+    Contents of at least `segment_threshold` bytes are fetched as `segments` byte ranges
+    at the same time.
+
+    Queued contents of all titles are started according to `order`: `fifo` in the order
+    they were queued, `smallest` or `largest` by size first, and `priority` in the order
+    of their titles in the batch.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 1,
+        per_title_jobs: int = 1,
+        segments: int = 1,
+        segment_threshold: int = DEFAULT_SEGMENT_THRESHOLD,
+        order: str = "fifo",
+    ) -> None:
+        if order not in QUEUE_ORDERS:
+            raise ValueError(f"unknown queue order {order}")
+        self.jobs = max(1, jobs)
+        self.per_title_jobs = max(1, min(per_title_jobs, self.jobs))
+        self.segments = max(1, segments)
+        self.segment_threshold = segment_threshold
+        self.order = order
+        self._sequence = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._title_executor: Optional[ThreadPoolExecutor] = None
+        self._content_executor: Optional[PriorityExecutor] = None
+        self._segment_executor: Optional[ThreadPoolExecutor] = None
+        self._plan_executor: Optional[ThreadPoolExecutor] = None
+
+    def _run_title(self, rank: int, call: Callable[[], Any]) -> Any:
+        self._local.rank = rank
+        return call()
+
+    def _priority(self, size: int) -> Tuple[int, ...]:
+        sequence = next(self._sequence)
+        if self.order == "smallest":
+            return size, sequence
+        if self.order == "largest":
+            return -size, sequence
+        if self.order == "priority":
+            return getattr(self._local, "rank", 0), sequence
+        return (sequence,)
+
+    def run_titles(self, calls: Iterable[Callable[[], Any]]) -> List[Any]:
+        """Runs the calls of a batch of titles and returns their results, in the same order."""
+        if self.jobs == 1:
+            return [self._run_title(rank, call) for rank, call in enumerate(calls)]
+        with self._lock:
+            if self._title_executor is None:
+                self._title_executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="title")
+            executor = self._title_executor
+        futures = [
+            executor.submit(contextvars.copy_context().run, self._run_title, rank, call)
+            for rank, call in enumerate(calls)
+        ]
+        return collect(futures)
+
+    def run_plans(self, calls: Iterable[Callable[[], Any]]) -> List[Any]:
+        """Runs the planning calls of a batch of titles, at least `PLAN_JOBS` at a time, and returns their results."""
+        with self._lock:
+            if self._plan_executor is None:
+                self._plan_executor = ThreadPoolExecutor(
+                    max_workers=max(self.jobs, PLAN_JOBS), thread_name_prefix="plan"
+                )
+            executor = self._plan_executor
+        futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+        return collect(futures)
+
+    def run_contents(self, tasks: Iterable[Tuple[int, Callable[[], Optional[str]]]]) -> Optional[str]:
+        """Run the download tasks of a single title, at most `per_title_jobs` at a time.
+
+        Tasks are given with the number of bytes they download and return an error message on
+        failure. Once a task fails, or the engine is closed, no more tasks are started, the ones
+        already running are waited for and the first error is returned.
+        """
+        ordered = [(self._priority(size), task) for size, task in tasks]
+        if self.order != "priority":
+            ordered.sort(key=lambda item: item[0])
+
+        if self.per_title_jobs == 1:
+            for _, task in ordered:
+                error = "Download cancelled" if self._closing.is_set() else task()
+                if error:
+                    return error
+            return None
+
+        with self._lock:
+            if self._content_executor is None:
+                self._content_executor = PriorityExecutor(max_workers=self.jobs, thread_name_prefix="content")
+            executor = self._content_executor
+        pending: Set[Future] = set()
+        remaining = iter(ordered)
+        error = None
+        while True:
+            while error is None and len(pending) < self.per_title_jobs:
+                next_task = next(remaining, None)
+                if next_task is None:
+                    break
+                if self._closing.is_set():
+                    error = "Download cancelled"
+                    break
+                pending.add(executor.submit(*next_task))
+            if not pending:
+                return error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = "Download cancelled" if future.cancelled() else future.result()
+                if result and error is None:
+                    error = result
+
+    def run_segments(self, tasks: Iterable[Callable[[], None]]) -> None:
+        """Run the segment downloads of a single content, raising the first error once all of them ended."""
+        if self.segments == 1:
+            for task in tasks:
+                task()
+            return
+        with self._lock:
+            if self._segment_executor is None:
+                self._segment_executor = ThreadPoolExecutor(
+                    max_workers=self.jobs * self.segments, thread_name_prefix="segment"
+                )
+            executor = self._segment_executor
+        futures = [executor.submit(task) for task in tasks]
+        error: Optional[BaseException] = None
+        for future in futures:
+            # a segment cancelled by close() never shows up as done for wait()
+            try:
+                future.result()
+            except BaseException as e:  # pylint: disable=broad-except
+                error = error or e
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        """Stops the worker pools: queued work is cancelled and the work already running is waited for."""
+        self._closing.set()
+        executors = (self._title_executor, self._content_executor, self._segment_executor, self._plan_executor)
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown()
+        self._title_executor = self._content_executor = self._segment_executor = self._plan_executor = None
+
+
+ConnectionKey = Tuple[str, str, int, Optional[str]]
+
+
+class PooledResponse:
+    """Response of a pooled connection, hands the connection back to the pool once the body has been read."""
+
+    def __init__(self, pool: "ConnectionPool", key: ConnectionKey, conn: HTTPConnection, response: HTTPResponse):
+        self._pool = pool
+        self._key = key
+        self._conn: Optional[HTTPConnection] = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.ttfb: Optional[float] = None
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self.response.read(amt)
+
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        return self.response.readinto(b)
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        # only a fully read response leaves the connection in a reusable state
+        if self.response.isclosed() and not self.response.will_close:
+            self._pool.release(self._key, conn)
+        else:
+            self.response.close()
+            conn.close()
+
+    def __enter__(self) -> "PooledResponse":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class ConnectionPool:
+    """HTTP/1.1 keep-alive connections shared by every download, keyed by host.
+
+    At most `max_size` idle connections are kept per host, and idle connections older
+    than `idle_timeout` seconds are closed instead of being reused.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT,
+        policy: RetryPolicy = RETRY_POLICY,
+    ) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._idle: Dict[ConnectionKey, List[Tuple[HTTPConnection, float]]] = {}
+
+    def _key(self, scheme: str, host: str, port: int) -> ConnectionKey:
+        proxy = getproxies().get(scheme)
+        if proxy and proxy_bypass(host):
+            proxy = None
+        return scheme, host, port, proxy
+
+    def _connect(self, key: ConnectionKey) -> HTTPConnection:
+        scheme, host, port, proxy = key
+        conn_class = HTTPSConnection if scheme == "https" else HTTPConnection
+        timeout = self.policy.connect_timeout
+        if not proxy:
+            return conn_class(host, port, timeout=timeout)
+        proxy_url = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        proxy_port = proxy_url.port or 80
+        if scheme == "https":
+            conn = HTTPSConnection(proxy_url.hostname or "", proxy_port, timeout=timeout)
+            conn.set_tunnel(host, port)
+            return conn
+        return HTTPConnection(proxy_url.hostname or "", proxy_port, timeout=timeout)
+
+    def _acquire(self, key: ConnectionKey) -> Tuple[HTTPConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def release(self, key: ConnectionKey, conn: HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle_lists, self._idle = list(self._idle.values()), {}
+        for idle in idle_lists:
+            for conn, _ in idle:
+                conn.close()
+
+    def _request(self, url: str, headers: Dict[str, str]) -> PooledResponse:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.hostname:
+            raise URLError(f"unsupported url {url}")
+        key = self._key(scheme, parts.hostname, parts.port or (443 if scheme == "https" else 80))
+        if key[3] and scheme == "http":
+            target = url
+        else:
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+        request_headers = {"User-Agent": USER_AGENT_HEADER, **headers}
+
+        while True:
+            conn, reused = self._acquire(key)
+            started = time.monotonic()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                # the connect timeout is over, from now on the socket waits for the server to answer
+                conn.sock.settimeout(self.policy.timeout_for(parts.hostname))
+                conn.request("GET", target, headers=request_headers)
+                response = conn.getresponse()
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    # the server dropped the idle connection, retry on a fresh one
+                    continue
+                raise URLError(e) from e
+            except (OSError, HTTPException) as e:
+                conn.close()
+                if isinstance(e, socket.timeout):
+                    raise
+                raise URLError(e) from e
+            pooled = PooledResponse(self, key, conn, response)
+            pooled.ttfb = round(time.monotonic() - started, 6)
+            self.policy.responded(parts.hostname, pooled.ttfb)
+            return pooled
+
+    def urlopen(self, url: str, headers: Optional[Dict[str, str]] = None) -> PooledResponse:
+        """Sends a GET request, following redirects, and raises `HTTPError` for error responses."""
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers or {})
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                drain(response)
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                drain(response)
+                raise HTTPError(url, response.status, response.response.reason, response.headers, None)
+            return response
+        raise URLError(f"too many redirects for {url}")
+
+
+def drain(response: PooledResponse, limit: int = 2**16) -> None:
+    """Reads a small unwanted body so the connection can be reused, anything bigger is dropped."""
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit() and int(length) <= limit:
+        response.read()
+    response.close()
+
+
+POOL = ConnectionPool()
+
+
+def content_range_start(content_range: Optional[str]) -> Optional[int]:
+    """
+    >>> content_range_start("bytes 1024-2047/2048")
+    1024
+    >>> content_range_start(None)
+    """
+    match = RE_CONTENT_RANGE.match(content_range or "")
+    return int(match.group(1)) if match else None
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class StalledDownload(ConnectionError):
+    pass
+
+
+def hash_file(fname: str, hasher: "hashlib._Hash", length: Optional[int] = None, chunk_size: int = 2**20) -> bytes:
+    """Feeds the first `length` bytes of a file, or all of them, to `hasher` and returns its digest."""
+    with open(fname, "rb") as f:
+        while length is None or length > 0:
+            buf = f.read(chunk_size if length is None else min(chunk_size, length))
+            if not buf:
+                break
+            hasher.update(buf)
+            if length is not None:
+                length -= len(buf)
+    return hasher.digest()
+
+
+_buffers = threading.local()
+
+
+def copy_stream(
+    infile: Any,
+    outfile: Any,
+    name: str,
+    planned: bool,
+    chunk_size: int,
+    hasher: Optional["hashlib._Hash"] = None,
+    length: Optional[int] = None,
+) -> int:
+    """Copies `infile` into `outfile` through a buffer reused by every download of the thread.
+
+    Reads start at `chunk_size` bytes and double, up to `MAX_CHUNK_SIZE`, while they keep
+    filling the buffer quickly, and halve while they take more than a second. At most `length`
+    bytes are copied if given. Returns the bytes copied.
+
+    Raises `StalledDownload` when less than `RETRY_POLICY.stall_speed` bytes per second arrive
+    for `RETRY_POLICY.stall_time` seconds, not counting the time spent on the rate limit.
+    """
+    buffer = getattr(_buffers, "view", None)
+    if buffer is None:
+        buffer = _buffers.view = memoryview(bytearray(MAX_CHUNK_SIZE))
+    size = min(chunk_size, MAX_CHUNK_SIZE)
+    if SCHEDULER.max_rate:
+        # keep a rate limited read loop from sleeping for seconds at a time
+        size = min(size, max(2**12, SCHEDULER.max_rate // 8))
+    stall_speed, stall_time = RETRY_POLICY.stall_speed, RETRY_POLICY.stall_time
+    copied = window_bytes = 0
+    window_start = last = time.monotonic()
+    throttled = 0.0
+    while length is None or copied < length:
+        n = infile.readinto(buffer[: size if length is None else min(size, length - copied)])
+        if not n:
+            break
+        now = time.monotonic()
+        slow = now - last > 1.0
+        chunk = buffer[:n]
+        outfile.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        copied += n
+        delay = SCHEDULER.transferred(n, planned)
+        if planned:
+            PROGRESS.advance(name, n)
+        if slow and size > 2**12:
+            # keep a slow stream from blocking on a big buffer, so a stall is seen in time
+            size //= 2
+        elif n == size and size < MAX_CHUNK_SIZE and not SCHEDULER.max_rate:
+            size *= 2
+        last = now + delay
+        throttled += delay
+        window_bytes += n
+        if stall_speed and stall_time and now - window_start >= stall_time:
+            if window_bytes < stall_speed * (now - window_start - throttled):
+                raise StalledDownload(f"less than {bytes2human(stall_speed)}/s for {seconds2human(now - window_start)}")
+            window_start, window_bytes, throttled = last, 0, 0.0
+    return copied
+
+
+def download_stream(
+    url: str,
+    outfname: str,
+    expected_size: Optional[int],
+    chunk_size: int,
+    hasher: Optional["hashlib._Hash"] = None,
+    trace: Optional[Dict[str, Any]] = None,
+    counted: int = 0,
+) -> int:
+    """Downloads `url` into `outfname`, continuing a partial file with a range request where possible.
+
+    `hasher` is fed every byte of the file as it is written. The response status, time to
+    first byte, resume offset and bytes downloaded are stored in `trace`.
+
+    `counted` bytes of the file were already counted by earlier attempts, so only the part of
+    the resumed file beyond them is counted as already on disk. The bytes this attempt counts
+    are added to `trace["counted"]`.
+    """
+    trace = {} if trace is None else trace
+    trace.setdefault("counted", 0)
+    disk_size = os.path.getsize(outfname) if os.path.isfile(outfname) else 0
+    # resume a partial content where it stopped, either in an earlier attempt or an earlier run
+    resume_from = disk_size if expected_size and disk_size < expected_size else 0
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+    try:
+        with POOL.urlopen(url, headers) as infile:
+            trace.update(status=infile.status, ttfb=infile.ttfb)
+            if resume_from and infile.status != 206:
+                log("-Server does not support resuming, downloading the whole file.")
+                resume_from = 0
+            elif resume_from:
+                if content_range_start(infile.headers.get("Content-Range")) != resume_from:
+                    # the partial file can't be trusted anymore, start over on the next attempt
+                    truncate(outfname)
+                    raise HTTPException(f"unexpected Content-Range {infile.headers.get('Content-Range')}")
+                log(f"-Resuming from {bytes2human(resume_from)}.")
+                SCHEDULER.skip(max(0, resume_from - counted))
+                trace["counted"] += max(0, resume_from - counted)
+                if hasher is not None:
+                    hash_file(outfname, hasher, resume_from)
+            trace["resumed_from"] = resume_from
+            if expected_size:
+                PROGRESS.start(outfname, expected_size, resume_from)
+            with open(outfname, "ab" if resume_from else "wb") as outfile:
+                try:
+                    copied = copy_stream(infile, outfile, outfname, bool(expected_size), chunk_size, hasher)
+                finally:
+                    # what a failed copy wrote is continued from, and was counted while it arrived
+                    trace["bytes"] = outfile.tell() - resume_from
+                    trace["counted"] += trace["bytes"]
+                downloaded_size = resume_from + copied
+    finally:
+        PROGRESS.finish(outfname)
+    return downloaded_size
+
+
+def kept_size(outfname: str) -> int:
+    """Bytes of a partial download that the next attempt continues from."""
+    parts_fname = outfname + ".parts"
+    try:
+        if os.path.isfile(parts_fname):
+            with open(parts_fname, encoding="utf-8") as f:
+                state = json.load(f)
+            return len(state["done"]) * state["segment_size"]
+        return os.path.getsize(outfname)
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def load_segments(parts_fname: str, expected_size: int, segment_count: int, outfname: str) -> Dict[str, Any]:
+    had_parts = os.path.isfile(parts_fname)
+    try:
+        with open(parts_fname, encoding="utf-8") as f:
+            state = json.load(f)
+        if state["size"] == expected_size and os.path.getsize(outfname) == expected_size:
+            return state
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    segment_size = -(-expected_size // segment_count)
+    disk_size = os.path.getsize(outfname) if os.path.isfile(outfname) else 0
+    done = []
+    if not had_parts and disk_size < expected_size:
+        # a sequential partial download already holds the segments before its end, while a file
+        # with an unreadable .parts may be preallocated and hold nothing at all
+        done = [i for i in range(segment_count) if min((i + 1) * segment_size, expected_size) <= disk_size]
+    state = {"size": expected_size, "segment_size": segment_size, "done": done}
+    # the segments are recorded before the file grows, so a full size file is never left without them
+    save_segments(parts_fname, state)
+    with open(outfname, "ab") as f:
+        f.truncate(expected_size)
+    return state
+
+
+def save_segments(parts_fname: str, state: Dict[str, Any]) -> None:
+    with open(parts_fname + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(parts_fname + ".tmp", parts_fname)
+
+
+def download_segmented(
+    url: str,
+    outfname: str,
+    expected_size: int,
+    engine: DownloadEngine,
+    chunk_size: int,
+    trace: Optional[Dict[str, Any]] = None,
+    counted: int = 0,
+) -> int:
+    """Downloads `url` as byte ranges fetched at the same time, each one written at its own offset.
+
+    Finished segments are recorded next to the file, in `<outfname>.parts`, so an interrupted
+    download only fetches the missing ones later. The file is preallocated to its full size.
+    `counted` and `trace["counted"]` work like for `download_stream`.
+    """
+    trace = {} if trace is None else trace
+    trace.update(status=206, bytes=0)
+    trace.setdefault("counted", 0)
+    parts_fname = outfname + ".parts"
+    state = load_segments(parts_fname, expected_size, engine.segments, outfname)
+    segment_size = state["segment_size"]
+    segment_count = -(-expected_size // segment_size)
+    missing = [i for i in range(segment_count) if i not in state["done"]]
+    lock = threading.Lock()
+    already_done = expected_size - sum(min(segment_size, expected_size - i * segment_size) for i in missing)
+    log(f"-Downloading {len(missing)} of {segment_count} segments.")
+    SCHEDULER.skip(max(0, already_done - counted))
+    trace["counted"] += max(0, already_done - counted)
+
+    def fetch(index: int) -> None:
+        start = index * segment_size
+        end = min(start + segment_size, expected_size) - 1
+        with POOL.urlopen(url, {"Range": f"bytes={start}-{end}"}) as infile:
+            if infile.status != 206:
+                raise RangeNotSupported(url)
+            if content_range_start(infile.headers.get("Content-Range")) != start:
+                raise HTTPException(f"unexpected Content-Range {infile.headers.get('Content-Range')}")
+            with open(outfname, "r+b") as outfile:
+                outfile.seek(start)
+                copied = copy_stream(infile, outfile, outfname, True, chunk_size, length=end + 1 - start)
+                with lock:
+                    trace["bytes"] += copied
+                if copied <= end - start:
+                    raise HTTPException(f"segment {index} of {url} ended early")
+        with lock:
+            state["done"].append(index)
+            save_segments(parts_fname, state)
+            trace["counted"] += end + 1 - start
+
+    PROGRESS.start(outfname, expected_size, already_done)
+    try:
+        engine.run_segments(partial(fetch, index) for index in missing)
+    finally:
+        PROGRESS.finish(outfname)
+    os.remove(parts_fname)
+    return expected_size
+
+
 def download_file(
     url: str,
     outfname: str,
@@ -80,11 +1228,39 @@ def download_file(
     ignore_404: bool = False,
     expected_size: Optional[int] = None,
     chunk_size: int = 2**16,
+    engine: Optional[DownloadEngine] = None,
+    expected_hash: Optional[bytes] = None,
 ):
-    for _ in retry(retry_count):
+    parts_fname = outfname + ".parts"
+    host = urlsplit(url).hostname
+    # bytes of the file counted by the attempts so far, so a retry doesn't count them again as already on disk
+    counted = 0
+    trace: Dict[str, Any] = {}
+    for attempt in retry(retry_count, url, partial(kept_size, outfname)):
+        started = time.monotonic()
+        counted += trace.get("counted", 0)
+        trace = {}
+        decision = "download"
+
+        def record(result: str, **fields: Any) -> None:
+            if METRICS.enabled:
+                METRICS.emit(
+                    "file",
+                    url=url,
+                    host=host,
+                    file=outfname,
+                    attempt=attempt,
+                    # a stream continuing a partial file is a resume, whether it ends well or not
+                    decision="resume" if decision == "download" and trace.get("resumed_from") else decision,
+                    result=result,
+                    status=trace.get("status"),
+                    ttfb=trace.get("ttfb"),
+                    bytes=trace.get("bytes", 0),
+                    seconds=round(time.monotonic() - started, 6),
+                    **fields,
+                )
+
         try:
-            request = Request(url, headers={"User-Agent": USER_AGENT_HEADER})
-            infile = urlopen(request, timeout=DEFAULT_TIMEOUT)
             # start of modified code
             if os.path.isfile(outfname):
                 statinfo = os.stat(outfname)
@@ -93,41 +1269,725 @@ def download_file(
                 diskFilesize = 0
             log(f"-Downloading {outfname}.\n-File size is {expected_size}.\n-File in disk is {diskFilesize}.")
 
-            if expected_size != diskFilesize:  # noqa: WPS504 # default branch should be first
-                with open(outfname, "wb") as outfile:
-                    downloaded_size = 0
-                    while True:
-                        buf = infile.read(chunk_size)
-                        if not buf:
-                            break
-                        downloaded_size += len(buf)
-                        if expected_size and len(buf) == chunk_size:
-                            print(f" Downloaded {progress_bar(downloaded_size, expected_size)}", end="\r")
-                        outfile.write(buf)
+            hasher = hashlib.sha1() if expected_hash is not None else None
+            if hasher is not None and diskFilesize and expected_size in (None, diskFilesize):
+                if not os.path.isfile(parts_fname) and hash_file(outfname, hashlib.sha1()) == expected_hash:
+                    log("-File verified, skipped.")
+                    decision = "verified"
+                    record("ok")
+                    return True
+                if not os.path.isfile(parts_fname):
+                    log("-File in disk does not match its hash, downloading it again.")
+                    truncate(outfname)
+                    diskFilesize = 0
+
+            big = bool(expected_size and engine and engine.segments > 1 and expected_size >= engine.segment_threshold)
+            if expected_size and (os.path.isfile(parts_fname) or (big and expected_size != diskFilesize)):
+                decision = "segments"
+                try:
+                    downloaded_size = download_segmented(
+                        url, outfname, expected_size, engine or DownloadEngine(), chunk_size, trace, counted
+                    )
+                    if hasher is not None:
+                        # segments arrive out of order, so they can only be hashed once all are written
+                        hash_file(outfname, hasher)
+                except RangeNotSupported:
+                    log("-Server does not support segments, downloading the whole file.")
+                    os.remove(parts_fname)
+                    truncate(outfname)
+                    decision = "download"
+                    downloaded_size = download_stream(url, outfname, expected_size, chunk_size, hasher, trace, counted)
+            elif expected_size != diskFilesize:  # noqa: WPS504 # default branch should be first
+                downloaded_size = download_stream(url, outfname, expected_size, chunk_size, hasher, trace, counted)
             else:
-                print("-File skipped.")
+                log("-File skipped.")
+                decision = "skip"
                 downloaded_size = statinfo.st_size
+                SCHEDULER.skip(max(0, downloaded_size - counted))
             # end of modified code
 
             if expected_size is not None:
                 if os.path.getsize(outfname) == expected_size:
-                    print(f"Download complete: {bytes2human(downloaded_size)}\n" + " " * 40)
+                    log(f"Download complete: {bytes2human(downloaded_size)}\n")
                 else:
-                    print("Content download not correct size\n")
+                    log("Content download not correct size\n")
+                    record("size_mismatch")
                     continue
+            if hasher is not None and hasher.digest() != expected_hash:
+                log("Content download does not match its hash\n")
+                truncate(outfname)
+                record("hash_mismatch")
+                continue
         except HTTPError as e:
+            trace["status"] = e.code
             if e.code == 404 and ignore_404:
                 # We are ignoring this because its a 404 error, not a failure
+                record("not_found")
                 return True
+            if e.code == 416 and os.path.isfile(outfname) and not os.path.isfile(parts_fname):
+                # the partial file doesn't match the remote one, start over on the next attempt
+                truncate(outfname)
             logging.warning("Failed to download file %s: %s", url, e)
-        except (ConnectionError, URLError, RemoteDisconnected, socket.timeout) as e:
+            RETRY_POLICY.failed(host, e)
+            record("error", error=str(e))
+        except (ConnectionError, URLError, HTTPException, socket.timeout) as e:
             logging.warning("Failed to download file %s: %s", url, e)
+            RETRY_POLICY.failed(host, e)
+            record("error", error=str(e))
         else:
+            RETRY_POLICY.succeeded(host)
+            record("ok")
             return True
 
     return False
 
 
+class TitleKeys:
+    """Keysite entries indexed by title ID, region and type."""
+
+    def __init__(self, entries: List[Dict[str, Any]]) -> None:
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.by_region: Dict[Optional[str], List[int]] = {}
+        self.by_type: Dict[str, List[int]] = {}
+        self.entries = entries
+        for position, entry in enumerate(entries):
+            title_id = entry["titleID"].lower()
+            self.by_id[title_id] = entry
+            self.by_region.setdefault(entry.get("region", None), []).append(position)
+            self.by_type.setdefault(title_id[4:8], []).append(position)
+
+    def get(self, title_id: str) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(title_id.lower())
+
+    def unknown_regions(self) -> Iterator[Tuple[str, str]]:
+        for region, positions in self.by_region.items():
+            if region is not None and region not in ALL_REGIONS:
+                for position in positions:
+                    yield region, self.entries[position]["titleID"]
+
+    def select(self, regions: Iterable[str], types: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """Entries of any of `regions` and `types`, in keysite order."""
+        in_regions = set()
+        for region in regions:
+            in_regions.update(self.by_region.get(region, []))
+        in_types = set()
+        for typecheck in types:
+            in_types.update(self.by_type.get(typecheck, []))
+        for position in sorted(in_regions & in_types):
+            yield self.entries[position]
+
+
+_titlekeys_cache: Dict[str, Tuple[int, TitleKeys]] = {}
+
+
+def load_titlekeys(fname: str) -> TitleKeys:
+    """Reads a keysite data file, reusing the last read while the file is unchanged."""
+    path = os.path.abspath(fname)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _titlekeys_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, encoding="utf-8") as f:
+        titlekeys = TitleKeys(json.load(f))
+    _titlekeys_cache[path] = (mtime, titlekeys)
+    return titlekeys
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Values of a JSON array, parsed while its bytes arrive, holding one value at a time.
+
+    >>> list(iter_json_array([b'[{"a": 1}, {"b"', b': "c"}, 3', b"4]"]))
+    [{'a': 1}, {'b': 'c'}, 34]
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in itertools.chain(chunks, [b""]):
+        buffer += text.decode(chunk, final=not chunk)
+        position = 0
+        while True:
+            position = RE_JSON_SPACE.match(buffer, position).end()  # type: ignore[union-attr] # always matches
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("not a JSON array")
+                started = True
+                position += 1
+            elif buffer[position] == ",":
+                position += 1
+            elif buffer[position] == "]":
+                return
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break  # the value is still arriving
+                if end == len(buffer) and chunk:
+                    break  # a number might go on in the next chunk
+                yield value
+                position = end
+        buffer = buffer[position:]
+    raise ValueError("JSON array ended early")
+
+
+_titlekeys_locks: Dict[str, threading.Lock] = {}
+_titlekeys_locks_lock = threading.Lock()
+
+
+def titlekeys_lock(fname: str) -> threading.Lock:
+    with _titlekeys_locks_lock:
+        return _titlekeys_locks.setdefault(os.path.abspath(fname), threading.Lock())
+
+
+class TitleKeysDownload:
+    """Refreshes the local copy of the keysite data in `outfname`, only downloading it again if it changed.
+
+    The ETag and Last-Modified of the last download are kept in `<outfname>.meta`.
+    """
+
+    def __init__(self, keysite: str, outfname: str, retry_count: int = 3) -> None:
+        self.keysite = keysite
+        self.outfname = outfname
+        self.retry_count = retry_count
+        # the parsed copy, when the keysite had nothing newer
+        self.index: Optional[TitleKeys] = None
+
+    def entries(self) -> Iterator[Dict[str, Any]]:
+        """Yields the entries of a changed copy while it downloads, or sets `index` when the copy is unchanged.
+
+        After an error the download starts over, without yielding the entries that were already
+        yielded again. Raises `FunKiiUError` when the data can't be had.
+        """
+        # jobs of a daemon share the file, one of them refreshes it while the others wait to read it
+        with titlekeys_lock(self.outfname):
+            url = f"{self.keysite}/json"
+            meta_fname = self.outfname + ".meta"
+            meta: Dict[str, Optional[str]] = {}
+            if os.path.isfile(self.outfname) and os.path.isfile(meta_fname):
+                try:
+                    with open(meta_fname, encoding="utf-8") as f:
+                        meta = json.load(f)
+                except ValueError:
+                    meta = {}
+            headers = {}
+            if meta.get("url") == url:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"] or ""
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"] or ""
+
+            host = urlsplit(url).hostname
+            yielded = 0
+            tmp_fname = f"{self.outfname}.{os.getpid()}.{threading.get_ident()}.tmp"
+            for attempt in retry(self.retry_count, url, lambda: yielded):
+                started = time.monotonic()
+                status: Optional[int] = None
+                downloaded = 0
+
+                def tee(infile: Any, outfile: Any) -> Iterator[bytes]:
+                    nonlocal downloaded
+                    for chunk in iter(partial(infile.read, 2**16), b""):
+                        outfile.write(chunk)
+                        downloaded += len(chunk)
+                        SCHEDULER.transferred(len(chunk), False)
+                        yield chunk
+
+                try:
+                    with POOL.urlopen(url, headers) as infile:
+                        status, ttfb = infile.status, infile.ttfb
+                        if infile.status == 304:
+                            log("-Data file not modified.")
+                            infile.read()
+                            self.index = load_titlekeys(self.outfname)
+                        else:
+                            with open(tmp_fname, "wb") as outfile:
+                                for position, entry in enumerate(iter_json_array(tee(infile, outfile))):
+                                    if position >= yielded:
+                                        yielded += 1
+                                        yield entry
+                            os.replace(tmp_fname, self.outfname)
+                            meta = {
+                                "url": url,
+                                "etag": infile.headers.get("ETag"),
+                                "last_modified": infile.headers.get("Last-Modified"),
+                            }
+                            with open(meta_fname, "w", encoding="utf-8") as f:
+                                json.dump(meta, f)
+                    RETRY_POLICY.succeeded(host)
+                    METRICS.emit(
+                        "file",
+                        url=url,
+                        host=host,
+                        file=self.outfname,
+                        attempt=attempt,
+                        decision="not_modified" if status == 304 else "download",
+                        result="ok",
+                        status=status,
+                        ttfb=ttfb,
+                        bytes=downloaded,
+                        seconds=round(time.monotonic() - started, 6),
+                    )
+                    return
+                except (ConnectionError, URLError, HTTPException, socket.timeout, ValueError) as e:
+                    logging.warning("Failed to download file %s: %s", url, e)
+                    if not isinstance(e, ValueError):
+                        RETRY_POLICY.failed(host, e)
+                    METRICS.emit(
+                        "file",
+                        url=url,
+                        host=host,
+                        file=self.outfname,
+                        attempt=attempt,
+                        decision="download",
+                        result="error",
+                        status=getattr(e, "code", status),
+                        ttfb=None,
+                        bytes=downloaded,
+                        seconds=round(time.monotonic() - started, 6),
+                        error=str(e),
+                    )
+                    headers = {}
+
+            raise FunKiiUError("ERROR: Could not download data file... Exiting.\n")
+
+
+class TMDContent(NamedTuple):
+    id: str
+    content_index: int
+    type: int
+    size: int
+    hash: bytes
+
+    @property
+    def hashed(self) -> bool:
+        return bool(self.type & CONTENT_TYPE_HASHED)
+
+    @property
+    def h3_hash(self) -> Optional[bytes]:
+        # for hashed contents the TMD holds the SHA-1 of the .h3 file; the hash of any other
+        # content is taken over its decrypted data, which can't be checked without the keys
+        return self.hash if self.hashed else None
+
+
+class TMD:
+    """Title metadata header fields and content records, parsed in one pass."""
+
+    __slots__ = ("title_id", "title_version", "contents")
+
+    def __init__(self, data: bytes) -> None:
+        view = memoryview(data)
+        if len(view) < TMD_CONTENTS_OFFSET:
+            raise ValueError(f"TMD is too short: {len(view)} bytes")
+        self.title_id = view[TK + 0x4C : TK + 0x54].hex()
+        self.title_version = bytes(view[TK + 0x9C : TK + 0x9E])
+        (content_count,) = struct.unpack_from(">H", view, TK + 0x9E)
+        end = TMD_CONTENTS_OFFSET + TMD_CONTENT_RECORD.size * content_count
+        if len(view) < end:
+            raise ValueError(f"TMD is too short for {content_count} contents: {len(view)} bytes")
+        self.contents = [
+            TMDContent(c_id.hex(), content_index, c_type, size, c_hash)
+            for c_id, content_index, c_type, size, c_hash in TMD_CONTENT_RECORD.iter_unpack(
+                view[TMD_CONTENTS_OFFSET:end]
+            )
+        ]
+
+    @classmethod
+    def from_file(cls, fname: str) -> "TMD":
+        with open(fname, "rb") as f:
+            return cls(f.read())
+
+    @property
+    def version(self) -> int:
+        return int.from_bytes(self.title_version, "big")
+
+    @property
+    def total_size(self) -> int:
+        return sum(content.size for content in self.contents)
+
+
+class Journal:
+    """Append-only record of the work finished in an output directory.
+
+    Every line is a JSON object: a `metadata` line once the TMD and ticket of a title are in
+    place, a `content` line per finished content and a `title` line once the whole title is
+    done. Entries are only trusted for the TMD version they were written for, and a ticket
+    only for where it came from, see `ticket_source`.
+    """
+
+    FILENAME = ".funkiiu-journal.jsonl"
+
+    def __init__(self, output_dir: str) -> None:
+        self.fname = os.path.join(output_dir, self.FILENAME)
+        self._lock = threading.Lock()
+        self.metadata: Dict[str, Dict[str, Any]] = {}
+        self.titles: Dict[str, int] = {}
+        self.contents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        if os.path.isfile(self.fname):
+            with open(self.fname, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        # a line cut short by an interrupted run
+                        continue
+        self._file: Optional[Any] = None
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        kind, title_id = record["kind"], record["title"]
+        if kind == "metadata":
+            self.metadata[title_id] = record
+            # a new TMD version invalidates whatever was done for the previous one
+            self.titles.pop(title_id, None)
+        elif kind == "content":
+            self.contents[title_id, record["content"]] = record
+        elif kind == "title":
+            self.titles[title_id] = record["version"]
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._apply(record)
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.fname) or ".", exist_ok=True)
+                self._file = open(self.fname, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def title_done(self, title_id: str) -> bool:
+        return title_id in self.titles
+
+    def metadata_done(self, title_id: str) -> Optional[int]:
+        record = self.metadata.get(title_id)
+        return record["version"] if record else None
+
+    def ticket_done(self, title_id: str, source: Dict[str, Any]) -> bool:
+        record = self.metadata.get(title_id)
+        return bool(record and all(record.get(key) == value for key, value in source.items()))
+
+    def content_done(self, title_id: str, version: int, content: TMDContent) -> bool:
+        record = self.contents.get((title_id, content.id))
+        return bool(
+            record
+            and record["version"] == version
+            and record["size"] == content.size
+            and record["hash"] == content.hash.hex()
+        )
+
+    def add_metadata(self, title_id: str, version: int, ticket: Dict[str, Any]) -> None:
+        self._write({"kind": "metadata", "title": title_id, "version": version, **ticket})
+
+    def add_content(self, title_id: str, version: int, content: TMDContent) -> None:
+        record = {"kind": "content", "title": title_id, "version": version, "content": content.id}
+        self._write({**record, "size": content.size, "hash": content.hash.hex()})
+
+    def add_title(self, title_id: str, version: int) -> None:
+        self._write({"kind": "title", "title": title_id, "version": version})
+
+
+def link_file(src: str, dst: str) -> str:
+    """Makes `dst` the same file as `src`: a hard link if possible, else a reflink, else a copy.
+
+    Returns which one of `link`, `reflink` or `copy` it was.
+    """
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+        method = "link"
+    except OSError:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            try:
+                if fcntl is None:
+                    raise OSError("reflinks are not supported")
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst, MAX_CHUNK_SIZE)
+                method = "copy"
+    os.replace(tmp, dst)
+    return method
+
+
+def truncate(fname: str) -> None:
+    """Empties a file, leaving alone the other names of a file linked from a content store."""
+    if os.stat(fname).st_nlink > 1:
+        os.remove(fname)
+        with open(fname, "wb"):
+            pass
+    else:
+        os.truncate(fname, 0)
+
+
+class ContentStore:
+    """Contents shared by every output directory, kept once under `root` and linked into titles.
+
+    Contents are stored by title ID and the hash the TMD has for them, or by title ID, content
+    ID and size when the TMD has no hash. The title ID is part of the key because contents are
+    encrypted with the title key, so the same hash in two titles is not the same file. The
+    access time of a stored content is when it was last used, so `evict` drops the least
+    recently used contents first.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, title_id: str, content: TMDContent) -> str:
+        key = content.hash.hex() if any(content.hash) else content.id
+        return os.path.join(self.root, title_id, f"{key}-{content.size}.app")
+
+    def _touch(self, path: str) -> None:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+
+    def has(self, title_id: str, content: TMDContent) -> bool:
+        try:
+            return os.path.getsize(self.path(title_id, content)) == content.size
+        except OSError:
+            return False
+
+    def fetch(self, title_id: str, content: TMDContent, outfname: str, outfnameh3: str) -> bool:
+        """Links a stored content, and its .h3 file, into a title; False if the store doesn't have it."""
+        path = self.path(title_id, content)
+        h3_path = path[: -len(".app")] + ".h3"
+        if not self.has(title_id, content):
+            return False
+        try:
+            if content.hashed and hash_file(h3_path, hashlib.sha1()) != content.h3_hash:
+                return False
+        except OSError:
+            return False
+        self._touch(path)
+        link_file(path, outfname)
+        if os.path.isfile(outfname + ".parts"):
+            os.remove(outfname + ".parts")
+        if content.hashed:
+            link_file(h3_path, outfnameh3)
+        return True
+
+    def add(self, title_id: str, content: TMDContent, outfname: str, outfnameh3: str) -> None:
+        """Stores a downloaded content, and its .h3 file, linking them where possible."""
+        path = self.path(title_id, content)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if content.hashed and os.path.isfile(outfnameh3):
+            link_file(outfnameh3, path[: -len(".app")] + ".h3")
+        link_file(outfname, path)
+        self._touch(path)
+
+    def contents(self) -> List[Tuple[str, os.stat_result]]:
+        found: List[Tuple[str, os.stat_result]] = []
+        for title in os.scandir(self.root):
+            if title.is_dir():
+                found.extend((entry.path, entry.stat()) for entry in os.scandir(title.path) if entry.is_file())
+        return found
+
+    def usage(self) -> str:
+        contents = self.contents()
+        size = sum(stat.st_size for _, stat in contents)
+        # files that are also linked into an output directory don't free any space when evicted
+        only_here = sum(stat.st_size for _, stat in contents if stat.st_nlink == 1)
+        titles = len({os.path.basename(os.path.dirname(path)) for path, _ in contents})
+        apps = sum(1 for path, _ in contents if path.endswith(".app"))
+        return (
+            f"Content store {self.root}: {apps} contents of {titles} titles, {bytes2human(size)}"
+            f" ({bytes2human(only_here)} not linked into any output directory)"
+        )
+
+    def evict(self, max_size: int) -> Tuple[int, int]:
+        """Removes the least recently used contents until the store holds at most `max_size` bytes.
+
+        Returns how many contents were removed and how many bytes they held.
+        """
+        contents = self.contents()
+        by_name = dict(contents)
+        size = sum(stat.st_size for _, stat in contents)
+        removed = freed = 0
+        apps = [(path, stat) for path, stat in contents if path.endswith(".app")]
+        for path, _ in sorted(apps, key=lambda item: item[1].st_atime):
+            if size <= max_size:
+                break
+            h3_path = path[: -len(".app")] + ".h3"
+            for name in (path, h3_path):
+                if name in by_name:
+                    os.remove(name)
+                    size -= by_name[name].st_size
+                    freed += by_name[name].st_size
+            removed += 1
+        for title in os.scandir(self.root):
+            if title.is_dir() and not os.listdir(title.path):
+                os.rmdir(title.path)
+        return removed, freed
+
+
+class TarArchive:
+    """Titles written straight into one tar archive, one file after another, instead of into directories.
+
+    Contents are streamed from the CDN into the archive without being stored anywhere else;
+    the TMD, ticket, certificate and .h3 files are small and go through `staging` first. One
+    title is written at a time. A title is recorded in `<archive>.index.json`, with where it
+    ends in the archive, once it is complete and synced, so an interrupted archive is cut back
+    to its last complete title and continued from there.
+    """
+
+    def __init__(self, fname: str) -> None:
+        self.fname = fname
+        self.index_fname = fname + ".index.json"
+        self.staging = fname + ".staging"
+        self.titles: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._start = 0
+        self._dirname = ""
+        try:
+            with open(self.index_fname, encoding="utf-8") as f:
+                self.titles = json.load(f)["titles"]
+        except FileNotFoundError:
+            if os.path.isfile(fname) and os.path.getsize(fname):
+                raise FunKiiUError(f"{fname} has no {self.index_fname}, so it can't be continued") from None
+        except (OSError, ValueError, KeyError) as e:
+            raise FunKiiUError(f"Could not read {self.index_fname}: {e}") from None
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        self._file = open(fname, "r+b" if os.path.isfile(fname) else "w+b")  # pylint: disable=consider-using-with
+        # anything after the last complete title is a title that was interrupted, or the end of the archive
+        self._file.truncate(self.end)
+        self._file.seek(self.end)
+
+    @property
+    def end(self) -> int:
+        return self.titles[-1]["end"] if self.titles else 0
+
+    def title_done(self, title_id: str) -> bool:
+        return any(title["title"] == title_id for title in self.titles)
+
+    def _header(self, name: str, size: int, kind: bytes = tarfile.REGTYPE) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = size if kind == tarfile.REGTYPE else 0
+        info.type = kind
+        info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+        info.mtime = int(time.time())
+        self._file.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    def _pad(self, size: int) -> None:
+        self._file.write(bytes(-size % tarfile.BLOCKSIZE))
+
+    def begin(self, dirname: str) -> None:
+        """Starts writing the title directory `dirname`, waiting for the title being written to finish."""
+        self._lock.acquire()  # pylint: disable=consider-using-with
+        self._start = self._file.tell()
+        self._dirname = dirname
+        try:
+            self._header(dirname, 0, tarfile.DIRTYPE)
+        except BaseException:
+            self.rollback()
+            raise
+
+    def add_file(self, name: str, fname: str) -> None:
+        size = os.path.getsize(fname)
+        self._header(f"{self._dirname}/{name}", size)
+        with open(fname, "rb") as f:
+            shutil.copyfileobj(f, self._file, MAX_CHUNK_SIZE)
+        self._pad(size)
+
+    def download(self, url: str, name: str, size: int, retry_count: int = 3, chunk_size: int = 2**16) -> bool:
+        """Streams `url`, of `size` bytes, into the title as `name`, continuing with a range request after an error."""
+        self._header(f"{self._dirname}/{name}", size)
+        data_start = self._file.tell()
+        label = f"{self.fname}:{self._dirname}/{name}"
+        host = urlsplit(url).hostname
+        log(f"-Downloading {url} into {self.fname}.\n-File size is {size}.")
+        PROGRESS.start(label, size)
+        try:
+            for attempt in retry(retry_count, url, lambda: self._file.tell() - data_start):
+                started = time.monotonic()
+                trace: Dict[str, Any] = {}
+                # a failed read leaves what it wrote before failing, the next request continues after that
+                written = self._file.tell() - data_start
+                try:
+                    with POOL.urlopen(url, {"Range": f"bytes={written}-"} if written else {}) as infile:
+                        trace.update(status=infile.status, ttfb=infile.ttfb)
+                        if written and (
+                            infile.status != 206 or content_range_start(infile.headers.get("Content-Range")) != written
+                        ):
+                            log("-Server does not support resuming, downloading the whole file again.")
+                            if infile.status != 200:
+                                raise HTTPException(f"unexpected Content-Range {infile.headers.get('Content-Range')}")
+                            self._file.seek(data_start)
+                            self._file.truncate()
+                            written = 0
+                            PROGRESS.start(label, size)
+                        copied = copy_stream(infile, self._file, label, True, chunk_size, length=size - written)
+                        written += copied
+                        trace["bytes"] = copied
+                    if written != size:
+                        raise HTTPException(f"{url} ended after {written} of {size} bytes")
+                except (ConnectionError, URLError, HTTPException, socket.timeout) as e:
+                    if isinstance(e, HTTPError):
+                        trace["status"] = e.code
+                    logging.warning("Failed to download file %s: %s", url, e)
+                    RETRY_POLICY.failed(host, e)
+                    result = "error"
+                else:
+                    RETRY_POLICY.succeeded(host)
+                    result = "ok"
+                if METRICS.enabled:
+                    METRICS.emit(
+                        "file",
+                        url=url,
+                        host=host,
+                        file=label,
+                        attempt=attempt,
+                        decision="archive",
+                        result=result,
+                        status=trace.get("status"),
+                        ttfb=trace.get("ttfb"),
+                        bytes=trace.get("bytes", 0),
+                        seconds=round(time.monotonic() - started, 6),
+                    )
+                if result == "ok":
+                    self._pad(size)
+                    log(f"Download complete: {bytes2human(size)}\n")
+                    return True
+            return False
+        finally:
+            PROGRESS.finish(label)
+
+    def commit(self, title_id: str, version: int) -> None:
+        """Records the title being written as complete, once it is safely on disk."""
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.titles.append({"title": title_id, "version": version, "dir": self._dirname, "end": self._file.tell()})
+            with open(self.index_fname + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"archive": os.path.basename(self.fname), "titles": self.titles}, f, indent=1)
+            os.replace(self.index_fname + ".tmp", self.index_fname)
+        finally:
+            self._lock.release()
+
+    def rollback(self) -> None:
+        """Drops what was written of the title being written."""
+        try:
+            self._file.seek(self._start)
+            self._file.truncate()
+        finally:
+            self._lock.release()
+
+    def close(self) -> None:
+        """Ends the archive after its last complete title, so it can be read while it is not continued."""
+        with self._lock:
+            self._file.seek(self.end)
+            self._file.truncate()
+            self._file.write(bytes(2 * tarfile.BLOCKSIZE))
+            self._file.close()
+        if os.path.isdir(self.staging) and not os.listdir(self.staging):
+            os.rmdir(self.staging)
+
+
 def patch_ticket_dlc(tikdata: bytearray) -> None:
     tikdata[TK + 0x164 : TK + 0x210] = b64decompress("eNpjYGQQYWBgWAPEIgwQNghoADEjELeAMTNE8D8BwEBjAABCdSH/")
 
@@ -144,6 +2004,13 @@ def make_ticket(
     patch_demo: bool = False,
     patch_dlc: bool = False,
 ) -> None:
+    with open(out_path, "wb") as f:
+        f.write(ticket_data(title_id, title_key, title_version, patch_demo, patch_dlc))
+
+
+def ticket_data(
+    title_id: str, title_key: str, title_version: bytes, patch_demo: bool = False, patch_dlc: bool = False
+) -> bytes:
     tikdata = bytearray(TIKTEM)
     tikdata[TK + 0xA6 : TK + 0xA8] = title_version
     tikdata[TK + 0x9C : TK + 0xA4] = binascii.a2b_hex(title_id)
@@ -155,8 +2022,7 @@ def make_ticket(
         patch_ticket_demo(tikdata)
     elif typecheck == "000c" and patch_dlc:
         patch_ticket_dlc(tikdata)
-    with open(out_path, "wb") as f:
-        f.write(tikdata)
+    return bytes(tikdata)
 
 
 def safe_filename(filename: str) -> str:
@@ -170,9 +2036,173 @@ def safe_filename(filename: str) -> str:
     return re.sub(r"_+", "_", "".join(c if (c.isalnum() or c in keep) else "_" for c in filename)).strip("_ ")
 
 
+def sync_files(*fnames: str) -> None:
+    """Makes sure files, and directories, that exist are on disk."""
+    for fname in fnames:
+        if not os.path.exists(fname) or (os.name == "nt" and os.path.isdir(fname)):
+            continue
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def archive_title(
+    archive: TarArchive, tmd: TMD, rawdir: str, baseurl: str, retry_count: int, finished: Set[str]
+) -> Optional[str]:
+    """Writes a title into an archive, one content after another; returns an error message on failure."""
+    for name in ("title.tmd", "title.tik", "title.cert"):
+        archive.add_file(name, os.path.join(rawdir, name))
+    for i, content in enumerate(tmd.contents):
+        log(f"Downloading {i + 1} of {len(tmd.contents)}.")
+        outfnameh3 = os.path.join(rawdir, content.id + ".h3")
+        # the .h3 file is small, it is downloaded first so it can follow its content in the archive
+        if not download_file(
+            f"{baseurl}/{content.id}.h3",
+            outfnameh3,
+            retry_count,
+            ignore_404=not content.hashed,
+            expected_hash=content.h3_hash,
+        ):
+            return "ERROR: Could not download h3 file... Skipping title"
+        if not archive.download(f"{baseurl}/{content.id}", content.id + ".app", content.size, retry_count):
+            return "ERROR: Could not download content file... Skipping title"
+        if os.path.isfile(outfnameh3):
+            archive.add_file(content.id + ".h3", outfnameh3)
+        finished.add(content.id)
+    return None
+
+
+def title_dir(output_dir: str, title_id: str, name: Optional[str] = None, region: Optional[str] = None) -> str:
+    if name:
+        dirname = f"{region}_{unidecode(name.replace(' ', '_').replace('.', ''))}_{title_id.upper()}"
+    else:
+        dirname = title_id.upper()
+
+    typecheck = title_id[4:8]
+    if typecheck == "000c":
+        dirname = dirname + "_DLC"
+    elif typecheck == "000e":
+        dirname = dirname + "_Update"
+
+    return os.path.join(output_dir, safe_filename(dirname))
+
+
+def ticket_source(title_id: str, onlinetickets: bool, patch_demo: bool, patch_dlc: bool) -> Dict[str, Any]:
+    """Where the ticket of a title comes from: `cetk` for updates, `keysite` or `generated` with its patches.
+
+    >>> ticket_source("0005000c10101c00", False, True, True)
+    {'ticket': 'generated', 'patch_demo': False, 'patch_dlc': True}
+    """
+    typecheck = title_id[4:8]
+    if typecheck == "000e":
+        return {"ticket": "cetk", "patch_demo": False, "patch_dlc": False}
+    if onlinetickets:
+        return {"ticket": "keysite", "patch_demo": False, "patch_dlc": False}
+    return {
+        "ticket": "generated",
+        "patch_demo": patch_demo and typecheck == "0002",
+        "patch_dlc": patch_dlc and typecheck == "000c",
+    }
+
+
+def metadata_reusable(title_id: str, rawdir: str, journal: Optional[Journal], revalidate: bool) -> bool:
+    """Whether the TMD and ticket of an interrupted title are reused, which they are unless asked to check them again."""
+    return bool(
+        journal
+        and not revalidate
+        and journal.metadata_done(title_id) is not None
+        and all(os.path.isfile(os.path.join(rawdir, name)) for name in ("title.tmd", "title.tik", "title.cert"))
+    )
+
+
+class TitlePlan(NamedTuple):
+    """What a title needs, worked out before any of its contents is downloaded."""
+
+    rawdir: str
+    tmd: Optional[TMD]  # None when the TMD couldn't be had
+    on_disk: int = 0  # content bytes already in the title directory or the content store
+    done: bool = False  # finished by an earlier run
+
+    @property
+    def size(self) -> int:
+        return self.tmd.total_size if self.tmd else 0
+
+
+def plan_title(
+    title_id: str,
+    rawdir: str,
+    retry_count: int = 3,
+    cdn: str = DEFAULT_CDN,
+    journal: Optional[Journal] = None,
+    revalidate: bool = False,
+    store: Optional[ContentStore] = None,
+    simulate: bool = False,
+) -> TitlePlan:
+    """Gets the TMD of a title into its directory and counts the content bytes that are already there.
+
+    The TMD of an earlier run is used when the journal allows it. A simulation downloads the
+    TMD to a temporary directory instead, and leaves the output directory alone.
+    """
+    CURRENT_TITLE.set(title_id)
+    tmd_path = os.path.join(rawdir, "title.tmd")
+    url = f"{cdn.rstrip('/')}/{title_id}/tmd"
+    done = bool(journal and not revalidate and journal.title_done(title_id) and os.path.isdir(rawdir))
+    try:
+        if done or metadata_reusable(title_id, rawdir, journal, revalidate) or (simulate and os.path.isfile(tmd_path)):
+            tmd = TMD.from_file(tmd_path)
+        elif simulate:
+            with tempfile.TemporaryDirectory(prefix="funkiiu-") as tmpdir:
+                if not download_file(url, os.path.join(tmpdir, "title.tmd"), retry_count):
+                    log(f"ERROR: Could not download TMD of {title_id}...")
+                    return TitlePlan(rawdir, None)
+                tmd = TMD.from_file(os.path.join(tmpdir, "title.tmd"))
+        else:
+            os.makedirs(rawdir, exist_ok=True)
+            if not download_file(url, tmd_path, retry_count):
+                log(f"ERROR: Could not download TMD of {title_id}...")
+                log("MAYBE YOU ARE BLOCKING CONNECTIONS TO NINTENDO? IF YOU ARE, DON'T...! :)")
+                return TitlePlan(rawdir, None)
+            tmd = TMD.from_file(tmd_path)
+    except (OSError, ValueError) as e:
+        if not done:
+            log(f"ERROR: Could not read TMD of {title_id}: {e}")
+        return TitlePlan(rawdir, None, done=done)
+
+    if done:
+        return TitlePlan(rawdir, tmd, tmd.total_size, done)
+    on_disk = 0
+    for content in tmd.contents:
+        outfname = os.path.join(rawdir, content.id + ".app")
+        if store and store.has(title_id, content):
+            on_disk += content.size
+        elif os.path.isfile(outfname):
+            on_disk += min(kept_size(outfname), content.size)
+    return TitlePlan(rawdir, tmd, on_disk)
+
+
+def preallocate(outfname: str, size: int, segment_count: int) -> None:
+    """Reserves the disk space of a content that is not downloaded yet.
+
+    The file is given a `.parts` file like a segmented download, so it is downloaded in place
+    later and a partial download is kept.
+    """
+    parts_fname = outfname + ".parts"
+    if os.path.isfile(parts_fname) or (os.path.isfile(outfname) and os.path.getsize(outfname) >= size):
+        return
+    load_segments(parts_fname, size, segment_count, outfname)
+    if hasattr(os, "posix_fallocate"):
+        with open(outfname, "r+b") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                pass  # the file system can't, so the file stays sparse
+
+
 def process_title_id(
     title_id: str,
-    title_key: str,
+    title_key: Optional[str],
     output_dir: str,
     name: Optional[str] = None,
     region: Optional[str] = None,
@@ -183,94 +2213,444 @@ def process_title_id(
     simulate: bool = False,
     tickets_only: bool = False,
     keysite: Optional[str] = None,
-) -> None:
-    if name:
-        dirname = f"{region}_{unidecode(name.replace(' ', '_').replace('.', ''))}_{title_id.upper()}"
-    else:
-        dirname = title_id.upper()
+    engine: Optional[DownloadEngine] = None,
+    journal: Optional[Journal] = None,
+    revalidate: bool = False,
+    cdn: str = DEFAULT_CDN,
+    store: Optional["ContentStore"] = None,
+    planned: Optional[TMD] = None,
+    archive: Optional[TarArchive] = None,
+    fsync: bool = False,
+) -> str:
+    """Downloads a title, returning what became of it: `done`, `skipped`, `failed`, `tickets_only` or `simulated`.
 
-    typecheck = title_id[4:8]
-    if typecheck == "000c":
-        dirname = dirname + "_DLC"
-    elif typecheck == "000e":
-        dirname = dirname + "_Update"
+    A title whose ticket couldn't be downloaded from the keysite is `ticket_failed` instead of `failed`.
+
+    A `planned` TMD comes from `plan_title`, which already saved it in the title directory. Its
+    contents must have been counted in the plan of the `SCHEDULER`, unless simulating or only
+    getting tickets.
+
+    With an `archive`, `output_dir` is the staging directory of the archive and the title ends
+    up in the archive. With `fsync`, every file is synced to disk before it is recorded in the
+    journal.
+    """
+    CURRENT_TITLE.set(title_id)
+    started = time.monotonic()
+
+    # contents counted in the plan of the SCHEDULER, a failed title takes the unfinished ones out again
+    counted: List[TMDContent] = list(planned.contents) if planned and not (simulate or tickets_only) else []
+    finished: Set[str] = set()
 
-    rawdir = os.path.join(output_dir, safe_filename(dirname))
+    def finish(result: str) -> str:
+        if result in ("failed", "ticket_failed"):
+            SCHEDULER.plan(-sum(content.size for content in counted if content.id not in finished))
+        METRICS.emit("title", result=result, seconds=round(time.monotonic() - started, 6))
+        return result
+
+    typecheck = title_id[4:8]
+    rawdir = title_dir(output_dir, title_id, name, region)
 
     if simulate:
-        log(f'Simulate: Would start work in in: "{rawdir}"')
-        return
+        tmd_path = os.path.join(rawdir, "title.tmd")
+        if planned is None and os.path.isfile(tmd_path):
+            planned = TMD.from_file(tmd_path)
+        if planned is not None:
+            log(
+                f'Simulate: Would start work in in: "{rawdir}" '
+                f"({len(planned.contents)} contents, {bytes2human(planned.total_size)})"
+            )
+        else:
+            log(f'Simulate: Would start work in in: "{rawdir}"')
+        return finish("simulated")
+
+    if journal and not revalidate and journal.title_done(title_id) and os.path.isdir(rawdir):
+        log(f'Title already downloaded in "{rawdir}", skipping. Use --revalidate to check it again.')
+        return finish("skipped")
 
     log(f'Starting work in: "{rawdir}"')
 
     if not os.path.exists(rawdir):
         os.makedirs(rawdir)
 
-    # download stuff
-    print("Downloading TMD...")
-
-    baseurl = f"http://ccs.cdn.c.shop.nintendowifi.net/ccs/download/{title_id}"
+    baseurl = f"{cdn.rstrip('/')}/{title_id}"
     tmd_path = os.path.join(rawdir, "title.tmd")
-    if not download_file(baseurl + "/tmd", tmd_path, retry_count):
-        print("ERROR: Could not download TMD...")
-        print("MAYBE YOU ARE BLOCKING CONNECTIONS TO NINTENDO? IF YOU ARE, DON'T...! :)")
-        print("Skipping title...")
-        return
+    cert_path = os.path.join(rawdir, "title.cert")
+    reuse_metadata = metadata_reusable(title_id, rawdir, journal, revalidate)
+    ticket = ticket_source(title_id, onlinetickets, patch_demo, patch_dlc)
+    reuse_ticket = bool(reuse_metadata and journal and journal.ticket_done(title_id, ticket))
+
+    if reuse_ticket:
+        log("Using the TMD and ticket of an earlier run...")
+    elif reuse_metadata:
+        log("Using the TMD of an earlier run, getting its ticket again as the last one came from elsewhere...")
+    else:
+        if planned is None:
+            # download stuff
+            log("Downloading TMD...")
 
-    with open(os.path.join(rawdir, "title.cert"), "wb") as f:
-        f.write(MAGIC)
+            if not download_file(baseurl + "/tmd", tmd_path, retry_count):
+                log("ERROR: Could not download TMD...")
+                log("MAYBE YOU ARE BLOCKING CONNECTIONS TO NINTENDO? IF YOU ARE, DON'T...! :)")
+                log("Skipping title...")
+                return finish("failed")
 
-    with open(tmd_path, "rb") as f:
-        tmd = f.read()
+        with open(cert_path, "wb") as f:
+            f.write(MAGIC)
 
-    title_version = tmd[TK + 0x9C : TK + 0x9E]
+    if planned is not None:
+        tmd = planned
+    else:
+        try:
+            tmd = TMD.from_file(tmd_path)
+        except ValueError as e:
+            log(f"ERROR: Could not read TMD: {e}")
+            log("Skipping title...")
+            return finish("failed")
 
     # get ticket from keysite, from cdn if game update, or generate ticket
-    if typecheck == "000e":
-        print("\nThis is an update, so we are getting the legit ticket straight from Nintendo.")
+    if reuse_ticket:
+        pass
+    elif typecheck == "000e":
+        log("\nThis is an update, so we are getting the legit ticket straight from Nintendo.")
         if not download_file(baseurl + "/cetk", os.path.join(rawdir, "title.tik"), retry_count):
-            print("ERROR: Could not download ticket from {}".format(baseurl + "/cetk"))
-            print("Skipping title...")
-            return
+            log("ERROR: Could not download ticket from {}".format(baseurl + "/cetk"))
+            log("Skipping title...")
+            return finish("failed")
     elif onlinetickets:
         tikurl = f"{keysite}/ticket/{title_id}.tik"
         if not download_file(tikurl, os.path.join(rawdir, "title.tik"), retry_count):
-            print(f"ERROR: Could not download ticket from {keysite}")
-            print("Skipping title...")
-            return
+            log(f"ERROR: Could not download ticket from {keysite}")
+            log("Skipping title...")
+            return finish("ticket_failed")
+    elif title_key:
+        make_ticket(title_id, title_key, tmd.title_version, os.path.join(rawdir, "title.tik"), patch_demo, patch_dlc)
     else:
-        make_ticket(title_id, title_key, title_version, os.path.join(rawdir, "title.tik"), patch_demo, patch_dlc)
+        log(f"ERROR: No title key to make a ticket for {title_id}")
+        log("Skipping title...")
+        return finish("failed")
+
+    if journal and not reuse_ticket:
+        journal.add_metadata(title_id, tmd.version, ticket)
 
     if tickets_only:
-        print("Ticket, TMD, and CERT completed. Not downloading contents.")
-        return
+        log("Ticket, TMD, and CERT completed. Not downloading contents.")
+        return finish("tickets_only")
+
+    log("Downloading Contents...")
+    content_count = len(tmd.contents)
+    log(f"Total size is {bytes2human(tmd.total_size)}\n")
+    if planned is None:
+        SCHEDULER.plan(tmd.total_size)
+        counted.extend(tmd.contents)
+
+    if archive is not None:
+        error: Optional[str] = "ERROR: Interrupted while writing the title into the archive"
+        archive.begin(os.path.basename(rawdir))
+        try:
+            error = archive_title(archive, tmd, rawdir, baseurl, retry_count, finished)
+        finally:
+            if error:
+                archive.rollback()
+            else:
+                archive.commit(title_id, tmd.version)
+        if error:
+            log(error)
+            return finish("failed")
+        shutil.rmtree(rawdir)
+        log(f'\nTitle written to "{archive.fname}"\n')
+        return finish("done")
+
+    def content_task(i: int, content: TMDContent) -> Callable[[], Optional[str]]:
+        outfname = os.path.join(rawdir, content.id + ".app")
+        outfnameh3 = os.path.join(rawdir, content.id + ".h3")
+
+        def skipped(decision: str) -> None:
+            SCHEDULER.skip(content.size)
+            METRICS.emit(
+                "file",
+                url=f"{baseurl}/{content.id}",
+                host=urlsplit(baseurl).hostname,
+                file=outfname,
+                attempt=1,
+                decision=decision,
+                result="ok",
+                status=None,
+                ttfb=None,
+                bytes=0,
+                seconds=0.0,
+            )
+            finished.add(content.id)
+
+        def task() -> Optional[str]:
+            log(f"Downloading {i + 1} of {content_count}.")
+            if (
+                journal
+                and not revalidate
+                and journal.content_done(title_id, tmd.version, content)
+                and os.path.isfile(outfname)
+                and os.path.getsize(outfname) == content.size
+            ):
+                log(f"-{content.id} was downloaded by an earlier run, skipped.")
+                skipped("journal")
+                return None
+            if store and store.fetch(title_id, content, outfname, outfnameh3):
+                log(f"-{content.id} taken from the content store.")
+                skipped("store")
+                if journal:
+                    journal.add_content(title_id, tmd.version, content)
+                return None
+            if not download_file(
+                f"{baseurl}/{content.id}", outfname, retry_count, expected_size=content.size, engine=engine
+            ):
+                return "ERROR: Could not download content file... Skipping title"
+            if not download_file(
+                f"{baseurl}/{content.id}.h3",
+                outfnameh3,
+                retry_count,
+                ignore_404=not content.hashed,
+                expected_hash=content.h3_hash,
+            ):
+                return "ERROR: Could not download h3 file... Skipping title"
+            finished.add(content.id)
+            if store:
+                store.add(title_id, content, outfname, outfnameh3)
+            if fsync:
+                sync_files(outfname, outfnameh3)
+            if journal:
+                journal.add_content(title_id, tmd.version, content)
+            return None
+
+        return task
+
+    error = (engine or DownloadEngine()).run_contents(
+        (content.size, content_task(i, content)) for i, content in enumerate(tmd.contents)
+    )
+    if error:
+        log(error)
+        return finish("failed")
+
+    if fsync:
+        sync_files(tmd_path, os.path.join(rawdir, "title.tik"), cert_path, rawdir, output_dir)
+    if journal:
+        journal.add_title(title_id, tmd.version)
+    log(f'\nTitle download complete in "{os.path.basename(rawdir)}"\n')
+    return finish("done")
+
+
+def sha1_file(fname: str) -> str:
+    """SHA-1 of a whole file, read through a memory map."""
+    with open(fname, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hashlib.sha1().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if hasattr(view, "madvise"):
+                view.madvise(mmap.MADV_SEQUENTIAL)
+            return hashlib.sha1(view).hexdigest()
+
+
+def check_title_dir(rawdir: str, full: bool = False) -> Tuple[Dict[str, Any], List[Tuple[str, Optional[str]]]]:
+    """Checks the files of a downloaded title that can be checked without hashing them.
+
+    Returns the report of the title and the files still to be hashed, with the SHA-1 they
+    must have (None when only their digest is wanted).
+    """
+    match = RE_TITLE_DIR.search(os.path.basename(rawdir))
+    report: Dict[str, Any] = {
+        "dir": rawdir,
+        "title": match.group(1).lower() if match else None,
+        "version": None,
+        "size": 0,
+        "problems": [],
+        "contents": [],
+    }
+    to_hash: List[Tuple[str, Optional[str]]] = []
+
+    def problem(fname: str, text: str) -> None:
+        report["problems"].append({"file": fname, "problem": text})
+
+    try:
+        tmd = TMD.from_file(os.path.join(rawdir, "title.tmd"))
+    except (OSError, ValueError) as e:
+        problem("title.tmd", f"unreadable: {e}")
+        return report, to_hash
+    report.update(title=tmd.title_id, version=tmd.version, size=tmd.total_size)
+
+    try:
+        with open(os.path.join(rawdir, "title.tik"), "rb") as f:
+            tik = f.read()
+        if len(tik) < len(TIKTEM) or tik[:4] != TIKTEM[:4]:
+            problem("title.tik", "not a ticket")
+        elif tik[TK + 0x9C : TK + 0xA4].hex() != tmd.title_id:
+            problem("title.tik", f"ticket of another title, {tik[TK + 0x9C : TK + 0xA4].hex()}")
+    except OSError:
+        problem("title.tik", "missing")
+    try:
+        with open(os.path.join(rawdir, "title.cert"), "rb") as f:
+            if f.read() != MAGIC:
+                problem("title.cert", "not the certificate chain FunKiiU writes")
+    except OSError:
+        problem("title.cert", "missing")
+
+    for content in tmd.contents:
+        app = os.path.join(rawdir, content.id + ".app")
+        entry: Dict[str, Any] = {"id": content.id, "size": content.size}
+        report["contents"].append(entry)
+        if not os.path.isfile(app):
+            problem(content.id + ".app", "missing")
+            continue
+        size = os.path.getsize(app)
+        if size != content.size:
+            problem(content.id + ".app", f"{size} bytes instead of {content.size}")
+        elif os.path.isfile(app + ".parts"):
+            problem(content.id + ".app", "some segments were never downloaded")
+        elif full:
+            to_hash.append((app, None))
+        if content.hashed:
+            h3 = os.path.join(rawdir, content.id + ".h3")
+            if os.path.isfile(h3):
+                to_hash.append((h3, (content.h3_hash or b"").hex()))
+            else:
+                problem(content.id + ".h3", "missing")
+    return report, to_hash
 
-    print("Downloading Contents...")
-    content_count = int(binascii.hexlify(tmd[TK + 0x9E : TK + 0xA0]), 16)
-
-    total_size = 0
-    for i in range(content_count):
-        c_offs = 0xB04 + (0x30 * i)
-        total_size += int(binascii.hexlify(tmd[c_offs + 0x08 : c_offs + 0x10]), 16)
-    print(f"Total size is {bytes2human(total_size)}\n")
-
-    for i in range(content_count):
-        c_offs = 0xB04 + (0x30 * i)
-        c_id = binascii.hexlify(tmd[c_offs : c_offs + 0x04]).decode()
-        # c_type = binascii.hexlify(tmd[c_offs + 0x06:c_offs + 0x8])
-        expected_size = int(binascii.hexlify(tmd[c_offs + 0x08 : c_offs + 0x10]), 16)
-        print(f"Downloading {i + 1} of {content_count}.")
-        outfname = os.path.join(rawdir, c_id + ".app")
-        outfnameh3 = os.path.join(rawdir, c_id + ".h3")
-
-        if not download_file(f"{baseurl}/{c_id}", outfname, retry_count, expected_size=expected_size):
-            print("ERROR: Could not download content file... Skipping title")
-            return
-        if not download_file(f"{baseurl}/{c_id}.h3", outfnameh3, retry_count, ignore_404=True):
-            print("ERROR: Could not download h3 file... Skipping title")
-            return
 
-    log(f'\nTitle download complete in "{dirname}"\n')
+def verify_tree(root: str, jobs: int = 1, full: bool = False) -> Dict[str, Any]:
+    """Checks every title below `root` and returns a report of what is missing or corrupt.
+
+    Tickets, certificates, sizes and .h3 files are always checked; contents are encrypted with
+    the title key, so the only check of their data is `full`, which reads every content and
+    records its SHA-1. Files are hashed by `jobs` processes.
+    """
+    started = time.monotonic()
+    titles = []
+    to_hash: List[Tuple[Dict[str, Any], str, Optional[str]]] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if "title.tmd" in filenames:
+            report, files = check_title_dir(dirpath, full)
+            titles.append(report)
+            to_hash.extend((report, fname, expected) for fname, expected in files)
+
+    # the biggest files first, so no process is left with a big one at the end
+    to_hash.sort(key=lambda item: -os.path.getsize(item[1]))
+    hashed = 0
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [(item, executor.submit(sha1_file, item[1])) for item in to_hash]
+        for (report, fname, expected), future in futures:
+            name = os.path.basename(fname)
+            try:
+                digest = future.result()
+            except OSError as e:
+                report["problems"].append({"file": name, "problem": f"unreadable: {e}"})
+                continue
+            hashed += os.path.getsize(fname)
+            if expected is not None and digest != expected:
+                report["problems"].append({"file": name, "problem": "does not match the hash in the TMD"})
+            elif name.endswith(".app"):
+                for entry in report["contents"]:
+                    if entry["id"] == name[: -len(".app")]:
+                        entry["sha1"] = digest
+
+    bad = [report for report in titles if report["problems"]]
+    return {
+        "root": root,
+        "titles": titles,
+        "summary": {
+            "titles": len(titles),
+            "bad_titles": len(bad),
+            "problems": sum(len(report["problems"]) for report in bad),
+            "size": sum(report["size"] for report in titles),
+            "hashed": hashed,
+            "seconds": round(time.monotonic() - started, 3),
+        },
+    }
+
+
+def write_repair_list(report: Dict[str, Any], fname: str) -> int:
+    """Writes the titles with problems as an argument file: `FunKiiU.py @FILE --online-tickets ...`."""
+    title_ids = sorted({title["title"] for title in report["titles"] if title["problems"] and title["title"]})
+    with open(fname, "w", encoding="utf-8") as f:
+        if title_ids:
+            f.write("\n".join(["--titles", *title_ids, "--revalidate"]) + "\n")
+    return len(title_ids)
+
+
+def free_space(path: str) -> int:
+    """Free bytes of the file system `path` is on, or would be on once created."""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def log_plan(output_dir: str, plans: List[TitlePlan], simulate: bool = False, space_check: bool = True) -> None:
+    """Logs the bytes a batch downloads, and refuses to start it when they don't fit in `output_dir`."""
+    size = sum(plan.size for plan in plans)
+    on_disk = sum(plan.on_disk for plan in plans)
+    needed = size - on_disk
+    free = free_space(output_dir)
+    eta = f", ETA {seconds2human(needed / SCHEDULER.max_rate)} at the --max-rate" if SCHEDULER.max_rate else ""
+    log(
+        f"Plan: {len(plans)} titles with {sum(len(plan.tmd.contents) for plan in plans if plan.tmd)} contents, "
+        f"{bytes2human(size)} in total, {bytes2human(on_disk)} already on disk, "
+        f"{bytes2human(needed)} to download{eta}, {bytes2human(free)} free in {output_dir}"
+    )
+    if needed > free:
+        message = f"Not enough free space in {output_dir} for {bytes2human(needed)}, {bytes2human(free)} free"
+        if space_check and not simulate:
+            raise FunKiiUError(f"ERROR: {message}. Use --no-space-check to start anyway.")
+        log(f"WARNING: {message}")
+
+
+def preallocate_title(title_id: str, plan: TitlePlan, engine: DownloadEngine, store: Optional[ContentStore]) -> None:
+    if plan.tmd is None or plan.done:
+        return
+    for content in plan.tmd.contents:
+        if store and store.has(title_id, content):
+            continue
+        segments = engine.segments if content.size >= engine.segment_threshold else 1
+        preallocate(os.path.join(plan.rawdir, content.id + ".app"), content.size, segments)
+
+
+class FunKiiUError(Exception):
+    """A batch that can't be started; `exit_code` is what the command line exits with."""
+
+    def __init__(self, message: str, exit_code: int = 1) -> None:
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+def configure(
+    jobs: int = 1,
+    per_title_jobs: int = 1,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    pool_idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT,
+    segments: int = 1,
+    segment_threshold: int = DEFAULT_SEGMENT_THRESHOLD,
+    max_rate: int = 0,
+    order: str = "fifo",
+    events_fname: Optional[str] = None,
+    prometheus_fname: Optional[str] = None,
+    stats: bool = False,
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+    stall_speed: int = DEFAULT_STALL_SPEED,
+    stall_time: float = DEFAULT_STALL_TIME,
+    breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+) -> DownloadEngine:
+    """Applies the settings shared by every batch of a process and returns the engine to run them on."""
+    SCHEDULER.max_rate = max_rate
+    METRICS.configure(events_fname, stats, bool(prometheus_fname))
+    POOL.max_size = pool_size
+    POOL.idle_timeout = pool_idle_timeout
+    RETRY_POLICY.backoff = retry_backoff
+    RETRY_POLICY.connect_timeout = connect_timeout
+    RETRY_POLICY.read_timeout = read_timeout
+    RETRY_POLICY.stall_speed = stall_speed
+    RETRY_POLICY.stall_time = stall_time
+    RETRY_POLICY.breaker_threshold = breaker_threshold
+    return DownloadEngine(jobs, per_title_jobs, segments, segment_threshold, order)
 
 
 def main(
@@ -286,143 +2666,491 @@ def main(
     simulate: bool = False,
     tickets_only: bool = False,
     keysite: Optional[str] = None,
-):
-    titlekeys_data = []
-
-    if download_regions and (titles or keys):
-        print("If using '-region', don't give Title IDs or keys, it gets all titles from the keysite")
-        sys.exit(0)
-    if keys and (len(keys) != len(titles)):
-        print("Number of keys and Title IDs do not match up")
-        sys.exit(0)
-    if titles and (not keys and not onlinekeys and not onlinetickets):
-        print("You also need to provide '-keys' or use '-onlinekeys' or '-onlinetickets'")
-        sys.exit(0)
-
-    if download_regions or onlinekeys or onlinetickets:
-
-        if keysite is None:
-            print("-keysite not specified")
-            sys.exit(1)
-
-        print(f"Downloading/updating data from {keysite}")
-
-        if not download_file(f"{keysite}/json", "titlekeys.json", retry_count):
-            print("ERROR: Could not download data file... Exiting.\n")
-            sys.exit(1)
-
-        print("Downloaded data OK!")
-
-        with open("titlekeys.json", encoding="utf-8") as f:
-            titlekeys_data = json.load(f)
-
-    for title_id in titles:
-        title_id = title_id.lower()
-        if not check_title_id(title_id):
-            print("The Title ID(s) must be 16 hexadecimal characters long")
-            print(f"{title_id} - is not ok.")
-            sys.exit(0)
-        title_key = None
-        name = None
-        region = None
-
-        patch = title_id[4:8] == "000e"
-
-        if keys:
-            title_key = keys.pop()
-            if not check_title_key(title_key):
-                print("The key(s) must be 32 hexadecimal characters long")
-                print(f"{title_id} - is not ok.")
-                sys.exit(0)
-        elif onlinekeys or onlinetickets:
-            title_data = next((t for t in titlekeys_data if t["titleID"] == title_id.lower()), None)
-
-            if not patch:
-                if not title_data:
-                    print(f"ERROR: Could not find data on {keysite} for {title_id}, skipping")
-                    continue
-                elif onlinetickets:
-                    if title_data["ticket"] == "0":
-                        print(f"ERROR: Ticket not available on {keysite} for {title_id}")
-                        sys.exit(1)
-
-                elif onlinekeys:
-                    title_key = title_data["titleKey"]
-
-            if title_data:
-                name = title_data.get("name", None)
-                region = title_data.get("region", None)
-
-        if not (title_key or onlinetickets or patch):
-            print(f"ERROR: Could not find title or ticket for {title_id}")
-            continue
-
-        # assert title_key is not None
-        process_title_id(
+    jobs: int = 1,
+    per_title_jobs: int = 1,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    pool_idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT,
+    segments: int = 1,
+    segment_threshold: int = DEFAULT_SEGMENT_THRESHOLD,
+    revalidate: bool = False,
+    max_rate: int = 0,
+    order: str = "fifo",
+    events_fname: Optional[str] = None,
+    prometheus_fname: Optional[str] = None,
+    stats: bool = False,
+    cdn: str = DEFAULT_CDN,
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+    stall_speed: int = DEFAULT_STALL_SPEED,
+    stall_time: float = DEFAULT_STALL_TIME,
+    breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+    fallback_keys: bool = False,
+    store_dir: Optional[str] = None,
+    store_size: int = 0,
+    space_check: bool = True,
+    preallocate_files: bool = False,
+    archive_fname: Optional[str] = None,
+    fsync: bool = False,
+    engine: Optional[DownloadEngine] = None,
+) -> Dict[str, str]:
+    """Downloads a batch of titles and returns what became of each of them, by title ID.
+
+    Raises `FunKiiUError` when the batch can't be started. Without an `engine` the settings
+    are applied with `configure` first, and the connections and workers are shut down at the
+    end; with an engine from an earlier `configure` they are kept for the next batch.
+    """
+    own_engine = engine is None
+    if engine is None:
+        engine = configure(
+            jobs,
+            per_title_jobs,
+            pool_size,
+            pool_idle_timeout,
+            segments,
+            segment_threshold,
+            max_rate,
+            order,
+            events_fname,
+            prometheus_fname,
+            stats,
+            retry_backoff,
+            connect_timeout,
+            read_timeout,
+            stall_speed,
+            stall_time,
+            breaker_threshold,
+        )
+    # keysite entries of the titles of the batch, by title ID
+    titlekeys: Dict[str, Dict[str, Any]] = {}
+    archive: Optional[TarArchive] = None
+    if archive_fname:
+        # only the small files of the titles are kept on disk, next to the archive
+        output_dir = archive_fname + ".staging"
+    journal = None if simulate or archive_fname else Journal(output_dir)
+    store = ContentStore(store_dir) if store_dir and not simulate else None
+    # title ID, title key, name, region and whether the ticket comes from the keysite
+    batch: List[Tuple[str, Optional[str], Optional[str], Optional[str], bool]] = []
+
+    plans: Dict[str, TitlePlan] = {}
+
+    def plan_call(entry: Tuple[str, Optional[str], Optional[str], Optional[str], bool]) -> Callable[[], TitlePlan]:
+        title_id, _, name, region, _ = entry
+        rawdir = title_dir(output_dir, title_id, name, region)
+        return partial(plan_title, title_id, rawdir, retry_count, cdn, journal, revalidate, store, simulate)
+
+    def title_call(entry: Tuple[str, Optional[str], Optional[str], Optional[str], bool]) -> Callable[[], str]:
+        title_id, title_key, name, region, tickets = entry
+        return partial(
+            process_title_id,
             title_id,
             title_key,
             output_dir,
             name,
             region,
             retry_count,
-            onlinetickets,
+            tickets,
             patch_demo,
             patch_dlc,
             simulate,
             tickets_only,
             keysite,
+            engine,
+            journal,
+            revalidate,
+            cdn,
+            store,
+            plans[title_id].tmd,
+            archive,
+            fsync,
         )
 
-    if download_regions:
-        for title_data in titlekeys_data:
+    try:
+        if archive_fname and (tickets_only or store_dir or preallocate_files):
+            raise FunKiiUError("An archive can't be written with --tickets-only, --store or --preallocate", 0)
+        if download_regions and (titles or keys):
+            raise FunKiiUError(
+                "If using '-region', don't give Title IDs or keys, it gets all titles from the keysite", 0
+            )
+        if keys and (len(keys) != len(titles)):
+            raise FunKiiUError("Number of keys and Title IDs do not match up", 0)
+        if titles and (not keys and not onlinekeys and not onlinetickets):
+            raise FunKiiUError("You also need to provide '-keys' or use '-onlinekeys' or '-onlinetickets'", 0)
+
+        if (download_regions or onlinekeys or onlinetickets) and keysite is None:
+            raise FunKiiUError("-keysite not specified")
+        if archive_fname and not simulate:
+            archive = TarArchive(archive_fname)
+
+        def in_archive(title_id: str) -> bool:
+            if archive and archive.title_done(title_id):
+                log(f'{title_id} is already in "{archive_fname}", skipping.')
+                return True
+            return False
+
+        if titles and (onlinekeys or onlinetickets):
+            log(f"Downloading/updating data from {keysite}")
+            wanted = {title_id.lower() for title_id in titles}
+            download = TitleKeysDownload(str(keysite), "titlekeys.json", retry_count)
+            for keysite_entry in download.entries():
+                if keysite_entry["titleID"].lower() in wanted:
+                    titlekeys[keysite_entry["titleID"].lower()] = keysite_entry
+            if download.index:
+                titlekeys = {title_id: entry for title_id in wanted if (entry := download.index.get(title_id))}
+            log("Downloaded data OK!")
+
+        for title_id in titles:
+            title_id = title_id.lower()
+            if not check_title_id(title_id):
+                raise FunKiiUError(
+                    f"The Title ID(s) must be 16 hexadecimal characters long\n{title_id} - is not ok.", 0
+                )
+            title_key = None
+            name = None
+            region = None
+            tickets = onlinetickets
+
+            patch = title_id[4:8] == "000e"
+
+            if keys:
+                title_key = keys.pop()
+                if not check_title_key(title_key):
+                    raise FunKiiUError(f"The key(s) must be 32 hexadecimal characters long\n{title_id} - is not ok.", 0)
+            elif onlinekeys or onlinetickets:
+                title_data = titlekeys.get(title_id)
+
+                if not patch:
+                    if not title_data:
+                        log(f"ERROR: Could not find data on {keysite} for {title_id}, skipping")
+                        continue
+                    elif onlinetickets:
+                        if title_data["ticket"] == "0":
+                            if not (fallback_keys and title_data.get("titleKey")):
+                                raise FunKiiUError(f"ERROR: Ticket not available on {keysite} for {title_id}")
+                            log(f"Ticket not available on {keysite} for {title_id}, using its title key")
+                            title_key = title_data["titleKey"]
+                            tickets = False
+
+                    elif onlinekeys:
+                        title_key = title_data["titleKey"]
+
+                if title_data:
+                    name = title_data.get("name", None)
+                    region = title_data.get("region", None)
+
+            if not (title_key or onlinetickets or patch):
+                log(f"ERROR: Could not find title or ticket for {title_id}")
+                continue
+
+            # assert title_key is not None
+            if not in_archive(title_id):
+                batch.append((title_id, title_key, name, region, tickets))
+
+        def region_entry(
+            title_data: Dict[str, Any]
+        ) -> Optional[Tuple[str, Optional[str], Optional[str], Optional[str], bool]]:
             title_id = title_data["titleID"]
             title_key = title_data.get("titleKey", None)
             name = title_data.get("name", None)
             region = title_data.get("region", None)
-            typecheck = title_id[4:8]
+            tickets = onlinetickets
 
-            if region is not None and region not in ALL_REGIONS:
-                logging.error("Found unknown region `%s` for titleid: %s", region, title_id)
-
-            if region not in download_regions:
-                continue
-            # only get games+dlcs+updates
-            if typecheck not in DOWNLOAD_TYPES:
-                continue
             if onlinetickets and (not title_data["ticket"]):
-                continue
+                if not (fallback_keys and title_key):
+                    return None
+                tickets = False
             elif onlinekeys and title_key is None:
-                continue
+                return None
+            if title_key is None and not (onlinetickets or title_id[4:8] == "000e"):
+                log(f"ERROR: Could not find title key for {title_id}, skipping")
+                return None
+            if in_archive(title_id):
+                return None
+
+            titlekeys[title_id.lower()] = title_data
+            batch.append((title_id, title_key, name, region, tickets))
+            return batch[-1]
+
+        def region_entries() -> Iterator[Tuple[str, Optional[str], Optional[str], Optional[str], bool]]:
+            """Titles of the regions, while changed keysite data is still downloading."""
+            log(f"Downloading/updating data from {keysite}")
+            regions = download_regions or ()
+            download = TitleKeysDownload(str(keysite), "titlekeys.json", retry_count)
+            for title_data in download.entries():
+                region = title_data.get("region", None)
+                if region is not None and region not in ALL_REGIONS:
+                    logging.error("Found unknown region `%s` for titleid: %s", region, title_data["titleID"])
+                # only get games+dlcs+updates
+                if region in regions and title_data["titleID"][4:8].lower() in DOWNLOAD_TYPES:
+                    entry = region_entry(title_data)
+                    if entry:
+                        yield entry
+            if download.index:
+                for region, title_id in download.index.unknown_regions():
+                    logging.error("Found unknown region `%s` for titleid: %s", region, title_id)
+                for title_data in download.index.select(regions, DOWNLOAD_TYPES):
+                    entry = region_entry(title_data)
+                    if entry:
+                        yield entry
+            log("Downloaded data OK!")
+
+        # the TMDs of the titles of the regions are fetched as soon as the keysite lists them
+        planned = engine.run_plans(map(plan_call, region_entries() if download_regions else list(batch)))
+        plans.update(zip((entry[0] for entry in batch), planned))
+        # a title whose TMD couldn't be had fails before anything else is downloaded
+        results = {title_id: "failed" for title_id, plan in plans.items() if plan.tmd is None and not plan.done}
+        batch = [entry for entry in batch if entry[0] not in results]
+        if batch and not tickets_only:
+            log_plan(output_dir, [plans[entry[0]] for entry in batch], simulate, space_check)
+            if preallocate_files and not simulate:
+                log("Preallocating the contents...")
+                for title_id, *_ in batch:
+                    preallocate_title(title_id, plans[title_id], engine, store)
+            if not simulate:
+                SCHEDULER.plan(sum(plans[entry[0]].size for entry in batch if not plans[entry[0]].done))
+        if engine.order in ("smallest", "largest"):
+            batch.sort(key=lambda entry: plans[entry[0]].size, reverse=engine.order == "largest")
+        results.update(zip((entry[0] for entry in batch), engine.run_titles(map(title_call, batch))))
+        if fallback_keys:
+            # titles whose ticket couldn't be downloaded get another try with a ticket made from their key
+            fallback = []
+            for title_id, _, name, region, _ in batch:
+                title_data = titlekeys.get(title_id.lower()) or {}
+                if results[title_id] == "ticket_failed" and title_data.get("titleKey"):
+                    log(f"Trying {title_id} again with its title key")
+                    fallback.append((title_id, title_data["titleKey"], name, region, False))
+            if not (simulate or tickets_only):
+                SCHEDULER.plan(sum(plans[entry[0]].size for entry in fallback))
+            results.update(zip((entry[0] for entry in fallback), engine.run_titles(map(title_call, fallback))))
+        if batch and not simulate and own_engine:
+            log(SCHEDULER.report())
+        if store and store_size:
+            removed, freed = store.evict(store_size)
+            if removed:
+                log(f"Removed {removed} least recently used contents ({bytes2human(freed)}) from the content store")
+        if stats:
+            log(METRICS.stats_table())
+        if prometheus_fname:
+            METRICS.write_prometheus(prometheus_fname)
+        return results
+    finally:
+        if own_engine:
+            engine.close()
+            POOL.close()
+            METRICS.close()
+        if journal:
+            journal.close()
+        if archive:
+            archive.close()
+
+
+def exit_code(results: Dict[str, str]) -> int:
+    return 1 if {"failed", "ticket_failed"} & set(results.values()) else 0
+
+
+# arguments of `main` that a daemon job may set, everything else comes from the daemon's command line
+JOB_FIELDS = (
+    "titles",
+    "keys",
+    "output_dir",
+    "onlinekeys",
+    "onlinetickets",
+    "fallback_keys",
+    "download_regions",
+    "retry_count",
+    "patch_demo",
+    "patch_dlc",
+    "simulate",
+    "tickets_only",
+    "keysite",
+    "revalidate",
+    "cdn",
+    "store_dir",
+    "store_size",
+    "space_check",
+    "preallocate_files",
+    "archive_fname",
+    "fsync",
+)
 
-            assert title_key is not None
-            process_title_id(
-                title_id,
-                title_key,
-                output_dir,
-                name,
-                region,
-                retry_count,
-                onlinetickets,
-                patch_demo,
-                patch_dlc,
-                simulate,
-                tickets_only,
-                keysite,
-            )
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """`POST /jobs` runs the batch in its JSON body and streams it back as JSON lines: `log` lines,
+    a `progress` line every second and a final `result` (title ID to result) or `error` line.
+    `GET /status` tells how many jobs are running and how far the downloads are.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "Daemon"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002 # same name as the base class
+        logging.debug(format, *args)
+
+    def send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path != "/status":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        self.send_json(200, {"jobs": self.server.running, "status": SCHEDULER.summary()})
+
+    def do_POST(self) -> None:
+        if self.path != "/jobs":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            unknown = set(job) - set(JOB_FIELDS)
+            if unknown:
+                raise ValueError(f"unknown job fields {', '.join(sorted(unknown))}")
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        streaming = True
+
+        def sink(line: str) -> None:
+            if streaming:
+                events.put({"event": "log", "message": line})
+
+        threading.Thread(target=self.server.run_job, args=(job, sink, events.put), daemon=True).start()
+        next_progress = time.monotonic() + 1.0
+        while True:
+            try:
+                event = events.get(timeout=max(0.0, next_progress - time.monotonic()))
+            except queue.Empty:
+                event = {"event": "progress", "status": SCHEDULER.summary()}
+                next_progress = time.monotonic() + 1.0
+            try:
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+                self.wfile.flush()
+            except OSError:
+                # the client is gone, the job goes on without it
+                streaming = False
+                return
+            if event["event"] in ("result", "error"):
+                return
+
+
+class Daemon(ThreadingHTTPServer):
+    """Runs the batches sent by `submit` on one engine, so the connection pool, the workers and the
+    keysite data stay warm between them. Jobs leave out what the daemon's `defaults` provide.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], engine: DownloadEngine, defaults: Dict[str, Any]) -> None:
+        super().__init__(address, DaemonHandler)
+        self.engine = engine
+        self.defaults = {name: value for name, value in defaults.items() if value is not None}
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def run_job(self, job: Dict[str, Any], sink: Callable[[str], None], done: Callable[[Dict[str, Any]], None]) -> None:
+        LOG_SINK.set(sink)
+        with self._lock:
+            self.running += 1
+        try:
+            arguments = {"titles": [], "keys": [], "output_dir": "install", **self.defaults, **job}
+            if arguments.get("download_regions"):
+                arguments["download_regions"] = tuple(arguments["download_regions"])
+            done({"event": "result", "results": main(**arguments, engine=self.engine)})
+        except FunKiiUError as e:
+            done({"event": "error", "message": str(e), "exit_code": e.exit_code})
+        except Exception as e:  # noqa: B902 # a failed job must not take the daemon down
+            logging.exception("Job %s failed", job)
+            done({"event": "error", "message": f"ERROR: {type(e).__name__}: {e}", "exit_code": 1})
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def serve(address: str, engine: DownloadEngine, defaults: Dict[str, Any]) -> None:
+    """Runs a `Daemon` on `[HOST:]PORT` (127.0.0.1 by default) until interrupted."""
+    host, _, port = address.rpartition(":")
+    daemon = Daemon((host or "127.0.0.1", int(port)), engine, defaults)
+    log(f"Waiting for jobs on http://{host or '127.0.0.1'}:{daemon.server_address[1]}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        engine.close()
+        POOL.close()
+        METRICS.close()
+
+
+def submit(url: str, job: Dict[str, Any]) -> int:
+    """Runs a batch on the daemon at `url`, showing its log as it goes, and returns the exit code."""
+    request = Request(url.rstrip("/") + "/jobs", json.dumps(job).encode(), {"Content-Type": "application/json"})
+    try:
+        with urlopen(request) as response:
+            for line in response:
+                event = json.loads(line)
+                if event["event"] == "log":
+                    log(event["message"])
+                elif event["event"] == "progress":
+                    PROGRESS.show(f" {event['status']}")
+                elif event["event"] == "result":
+                    return exit_code(event["results"])
+                elif event["event"] == "error":
+                    log(event["message"])
+                    return event["exit_code"]
+    except (URLError, HTTPException, OSError, ValueError) as e:
+        log(f"ERROR: Could not run the batch on {url}: {e}")
+        return 1
+    log(f"ERROR: {url} stopped before the batch was done")
+    return 1
 
 
 def log(output: str) -> None:
+    sink = LOG_SINK.get()
+    if sink is not None:
+        sink(output)
+        return
     if sys.stdout:
         _bytes = output.encode(sys.stdout.encoding, errors="replace")
         output = _bytes.decode(sys.stdout.encoding, errors="replace")
-    print(output)
+    PROGRESS.write(output)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(
-        description="FunKiiU by cearp and the cerea1killer", formatter_class=ArgumentDefaultsHelpFormatter
+        description="FunKiiU by cearp and the cerea1killer",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        fromfile_prefix_chars="@",
     )
     group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--verify",
+        metavar="DIR",
+        help="Check that the titles downloaded into this directory are complete and intact, without downloading",
+    )
+    group.add_argument(
+        "--store-usage",
+        action="store_true",
+        help="Show how much the content store given with --store holds and exit",
+    )
+    group.add_argument(
+        "--store-evict",
+        action="store_true",
+        help="Remove the least recently used contents from --store until it holds at most --store-size and exit",
+    )
+    group.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        help="Run as a daemon taking batches from --submit on this address, keeping connections and data warm",
+    )
     group.add_argument(
         "--regions",
         nargs="+",
@@ -474,15 +3202,198 @@ if __name__ == "__main__":
         help="Only download/generate tickets (and TMD and CERT), don't download any content",
     )
     parser.add_argument("--keysite", help="URL of the keysite. For example `https://aaa.bbb.ccc`")
+    parser.add_argument(
+        "--cdn",
+        help=f"Base URL the TMDs, tickets and contents are downloaded from, followed by `/<title id>/<file>`"
+        f" ({DEFAULT_CDN} if not given)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="How many titles and content files are downloaded at the same time, or files hashed by --verify",
+    )
+    parser.add_argument(
+        "--per-title-jobs",
+        type=int,
+        default=4,
+        help="How many content files of a single title are downloaded at the same time (capped by --jobs)",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=DEFAULT_SEGMENTS,
+        help="How many parts of a big content file are downloaded at the same time",
+    )
+    parser.add_argument(
+        "--segment-threshold",
+        type=human2bytes,
+        default=DEFAULT_SEGMENT_THRESHOLD,
+        help="Content files of at least this size (e.g. 256M) are downloaded in parts",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=human2bytes,
+        default=0,
+        help="Limit the overall download speed to this many bytes per second (e.g. 5M), 0 for no limit",
+    )
+    parser.add_argument(
+        "--order",
+        choices=QUEUE_ORDERS,
+        default="fifo",
+        help="Which queued content files start first: in queue order, smallest or largest first,"
+        " or in the order of their titles",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="Check titles and contents again even if an earlier run in the same output directory finished them",
+    )
+    parser.add_argument(
+        "--events",
+        metavar="FILE",
+        help="Append a JSON line per download attempt and per title to this file",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="Write a summary of the run in the Prometheus textfile format to this file",
+    )
+    parser.add_argument("--stats", action="store_true", help="Show a table of the downloads per title and per server")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="How many idle keep-alive connections are kept open per server",
+    )
+    parser.add_argument(
+        "--pool-idle-timeout",
+        type=float,
+        default=DEFAULT_POOL_IDLE_TIMEOUT,
+        help="Seconds after which an idle keep-alive connection is closed instead of reused",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=DEFAULT_RETRY_BACKOFF,
+        help="Seconds to wait before the first retry, doubled on every further retry (with jitter), 0 for no wait",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help="Seconds to wait for a connection to a server",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help="Most seconds to wait for a server to send data, less for servers that usually answer quickly",
+    )
+    parser.add_argument(
+        "--stall-speed",
+        type=human2bytes,
+        default=DEFAULT_STALL_SPEED,
+        help="Downloads slower than this many bytes per second for --stall-time seconds are restarted, 0 to never",
+    )
+    parser.add_argument(
+        "--stall-time",
+        type=float,
+        default=DEFAULT_STALL_TIME,
+        help="Seconds a download may be slower than --stall-speed",
+    )
+    parser.add_argument(
+        "--breaker-threshold",
+        type=int,
+        default=DEFAULT_BREAKER_THRESHOLD,
+        help=f"Failures in a row after which downloads from a server pause for {BREAKER_COOLDOWN:.0f} seconds,"
+        " 0 to never pause",
+    )
+    parser.add_argument(
+        "--fallback-keys",
+        action="store_true",
+        help="With --online-tickets, make the ticket from the title key for titles whose ticket can't be downloaded",
+    )
+    parser.add_argument(
+        "--verify-full",
+        action="store_true",
+        help="With --verify, also read every content and record its SHA-1, to find unreadable files",
+    )
+    parser.add_argument("--report", metavar="FILE", help="With --verify, write what was checked and found as JSON")
+    parser.add_argument(
+        "--repair",
+        metavar="FILE",
+        help="With --verify, write the titles with problems as arguments to download them again with `@FILE`",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="DIR",
+        help="Keep downloaded contents in this directory too, and link contents found there into titles"
+        " instead of downloading them again",
+    )
+    parser.add_argument(
+        "--store-size",
+        type=human2bytes,
+        default=0,
+        help="Remove the least recently used contents from --store after a batch while it holds more than this"
+        " (e.g. 500G), 0 for no limit",
+    )
+    parser.add_argument(
+        "--no-space-check",
+        dest="space_check",
+        action="store_false",
+        help="Start even when the contents to download don't fit in the free space of --out-dir",
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help="Reserve the disk space of every content before downloading any of them",
+    )
+    parser.add_argument(
+        "--archive",
+        metavar="FILE",
+        help="Write the titles into this tar archive instead of --out-dir, one after another."
+        " An interrupted archive is continued after its last complete title",
+    )
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="Make sure every downloaded file is on disk before it counts as done, e.g. for removable media",
+    )
+    parser.add_argument(
+        "--submit",
+        metavar="URL",
+        help="Run the batch on the daemon started with --serve at this URL (e.g. http://127.0.0.1:8765)",
+    )
     parser.add_argument("--version", action="version", version=__VERSION__)
     args = parser.parse_args()
 
-    main(
+    settings = dict(
+        jobs=args.jobs,
+        per_title_jobs=args.per_title_jobs,
+        pool_size=args.pool_size,
+        pool_idle_timeout=args.pool_idle_timeout,
+        segments=args.segments,
+        segment_threshold=args.segment_threshold,
+        max_rate=args.max_rate,
+        order=args.order,
+        events_fname=args.events,
+        prometheus_fname=args.prometheus,
+        stats=args.stats,
+        retry_backoff=args.retry_backoff,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        stall_speed=args.stall_speed,
+        stall_time=args.stall_time,
+        breaker_threshold=args.breaker_threshold,
+    )
+    batch = dict(
         titles=args.titles,
         keys=args.keys,
-        output_dir=args.out_dir,
+        output_dir=os.path.abspath(args.out_dir) if args.submit else args.out_dir,
         onlinekeys=args.online_keys,
         onlinetickets=args.online_tickets,
+        fallback_keys=args.fallback_keys,
         download_regions=args.regions,
         retry_count=args.retry_count,
         patch_demo=args.patch_demo,
@@ -490,4 +3401,52 @@ if __name__ == "__main__":
         simulate=args.simulate,
         tickets_only=args.tickets_only,
         keysite=args.keysite,
+        revalidate=args.revalidate,
+        cdn=args.cdn if args.cdn or args.submit else DEFAULT_CDN,
+        store_dir=os.path.abspath(args.store) if args.store and args.submit else args.store,
+        store_size=args.store_size,
+        space_check=args.space_check,
+        preallocate_files=args.preallocate,
+        archive_fname=os.path.abspath(args.archive) if args.archive and args.submit else args.archive,
+        fsync=args.fsync,
     )
+
+    if (args.store_usage or args.store_evict) and not args.store:
+        parser.error("--store-usage and --store-evict need --store")
+    if args.store_evict and not args.store_size:
+        # 0 is no limit everywhere else, it must not empty the store here
+        parser.error("--store-evict needs a --store-size larger than 0")
+    if args.verify:
+        report = verify_tree(args.verify, args.jobs, args.verify_full)
+        for title in report["titles"]:
+            for problem in title["problems"]:
+                log(f'{title["dir"]}: {problem["file"]} {problem["problem"]}')
+        summary = report["summary"]
+        log(
+            f"{summary['titles']} titles checked, {summary['bad_titles']} with problems,"
+            f" {bytes2human(summary['hashed'])} hashed in {seconds2human(summary['seconds'])}"
+        )
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        if args.repair:
+            count = write_repair_list(report, args.repair)
+            log(f"{count} titles to download again with: python3 FunKiiU.py @{args.repair} <keys or tickets options>")
+        sys.exit(1 if summary["bad_titles"] else 0)
+    elif args.store_usage:
+        log(ContentStore(args.store).usage())
+    elif args.store_evict:
+        removed, freed = ContentStore(args.store).evict(args.store_size)
+        log(f"Removed {removed} contents ({bytes2human(freed)})")
+        log(ContentStore(args.store).usage())
+    elif args.serve:
+        serve(args.serve, configure(**settings), {"keysite": args.keysite, "cdn": args.cdn})
+    elif args.submit:
+        sys.exit(submit(args.submit, {name: value for name, value in batch.items() if value is not None}))
+    else:
+        try:
+            results = main(**batch, **settings)
+        except FunKiiUError as e:
+            log(str(e))
+            sys.exit(e.exit_code)
+        sys.exit(exit_code(results))
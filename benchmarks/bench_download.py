@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+"""Measures whole FunKiiU runs against the local stand-in CDN and keysite of `fakecdn.py`.
+
+Every scenario starts FunKiiU in a new process with an empty output directory, downloads all
+the titles of the stand-in with `--regions` and reports the wall time, the throughput and the
+CPU time of the FunKiiU process. The downloaded contents are checked for their size.
+
+Results can be saved with `--save` and compared with a later run using `--compare`, which
+exits with an error when a scenario got slower than `--tolerance` allows.
+
+Usage: python3 benchmarks/bench_download.py [SCENARIO ...] [--scale X] [fault options] [--args "FunKiiU options"]
+"""
+
+import hashlib
+import json
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from fakecdn import FakeCDN, add_fault_arguments, make_titles, parse_faults
+
+FUNKIIU = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "FunKiiU.py")
+PROXY_VARIABLES = {"http_proxy", "https_proxy", "all_proxy"}
+
+
+class Scenario(NamedTuple):
+    titles: int
+    contents: int
+    size: int
+    archive: bool = False  # written with --archive, and checked byte for byte
+
+
+SCENARIOS = {
+    "single-title": Scenario(titles=1, contents=8, size=16 * 2**20),
+    "many-small-titles": Scenario(titles=100, contents=3, size=32 * 2**10),
+    "huge-content": Scenario(titles=1, contents=1, size=1 * 2**30),
+    "archive": Scenario(titles=3, contents=4, size=4 * 2**20, archive=True),
+}
+
+
+class Result(NamedTuple):
+    scenario: str
+    bytes: int
+    wall: float
+    cpu: float
+    ok: bool
+    requests: int
+    connections: int
+
+    @property
+    def speed(self) -> float:
+        return self.bytes / self.wall if self.wall else 0.0
+
+
+def run(name: str, scenario: Scenario, args) -> Result:
+    titles = make_titles(scenario.titles, scenario.contents, max(1, int(scenario.size * args.scale)))
+    server = FakeCDN(("127.0.0.1", 0), titles, parse_faults(args))
+    server.start()
+    env = {key: value for key, value in os.environ.items() if key.lower() not in PROXY_VARIABLES}
+    try:
+        with tempfile.TemporaryDirectory(prefix="funkiiu-bench-") as tmpdir:
+            out_dir = os.path.join(tmpdir, "install")
+            archive = os.path.join(tmpdir, "install.tar")
+            command = [
+                sys.executable,
+                FUNKIIU,
+                "--regions",
+                "EUR",
+                "--online-keys",
+                "--keysite",
+                server.url,
+                "--cdn",
+                server.url + "/ccs/download",
+                *(["--archive", archive] if scenario.archive else ["--out-dir", out_dir]),
+                *shlex.split(args.args),
+            ]
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            started = time.perf_counter()
+            with open(os.path.join(tmpdir, "funkiiu.log"), "w+", encoding="utf-8") as log:
+                process = subprocess.run(command, cwd=tmpdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+                wall = time.perf_counter() - started
+                after = resource.getrusage(resource.RUSAGE_CHILDREN)
+                ok = process.returncode == 0 and (
+                    check_archive(archive, titles) if scenario.archive else check_output(out_dir, titles)
+                )
+                if not ok and args.verbose:
+                    log.seek(0)
+                    print("".join(log.readlines()[-20:]), file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return Result(name, sum(title.size for title in titles), wall, cpu, ok, server.requests, server.connections)
+
+
+def check_output(out_dir: str, titles) -> bool:
+    sizes: Dict[str, int] = {}
+    for root, _, files in os.walk(out_dir):
+        for fname in files:
+            if fname.endswith(".app"):
+                sizes[os.path.join(os.path.basename(root)[-16:].lower(), fname[:-4])] = os.path.getsize(
+                    os.path.join(root, fname)
+                )
+    for title in titles:
+        for content in title.contents.values():
+            if sizes.get(os.path.join(title.id, content.id)) != content.size:
+                return False
+    return True
+
+
+def check_archive(fname: str, titles) -> bool:
+    expected = {os.path.join(title.id, content.id): content for title in titles for content in title.contents.values()}
+    found = 0
+    with tarfile.open(fname) as tar:
+        for member in tar:
+            if not member.name.endswith(".app"):
+                continue
+            content = expected.get(os.path.join(os.path.dirname(member.name)[-16:].lower(), member.name[-12:-4]))
+            data = tar.extractfile(member)
+            if content is None or data is None or member.size != content.size:
+                return False
+            hasher = hashlib.sha1()
+            for chunk in iter(lambda: data.read(2**20), b""):  # noqa: B023 # read right away
+                hasher.update(chunk)
+            if hasher.digest() != content_digest(content):
+                return False
+            found += 1
+    return found == len(expected)
+
+
+def content_digest(content) -> bytes:
+    hasher = hashlib.sha1()
+    for chunk in content.chunks(0, content.size):
+        hasher.update(chunk)
+    return hasher.digest()
+
+
+def settings(args) -> Dict[str, Any]:
+    """What has to match for two runs of a scenario to be comparable."""
+    return {"scale": args.scale, "args": args.args, **parse_faults(args)._asdict()}
+
+
+def print_results(results: List[Result], baseline: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+    print(
+        f"{'Scenario':<20}{'Size':>12}{'Wall':>10}{'Speed':>14}{'CPU':>9}{'CPU/GB':>9}"
+        f"{'Requests':>10}{'Conns':>7}  Result"
+    )
+    for result in results:
+        line = (
+            f"{result.scenario:<20}{result.bytes / 2**20:9.1f} MB{result.wall:9.2f}s"
+            f"{result.speed / 2**20:9.1f} MB/s{result.cpu:8.2f}s{result.cpu / (result.bytes / 2**30):8.2f}s"
+            f"{result.requests:>10}{result.connections:>7}  {'ok' if result.ok else 'FAILED'}"
+        )
+        if baseline and result.scenario in baseline:
+            line += f"  {result.speed / baseline[result.scenario]['speed'] - 1:+.1%} speed vs baseline"
+        print(line)
+
+
+def regressions(results: List[Result], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    found = []
+    for result in results:
+        if not result.ok:
+            found.append(f"{result.scenario} failed")
+            continue
+        previous = baseline.get(result.scenario)
+        if previous and result.speed < previous["speed"] * (1 - tolerance):
+            found.append(f"{result.scenario} is {1 - result.speed / previous['speed']:.1%} slower")
+    return found
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmarks FunKiiU against a local stand-in CDN and keysite")
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="SCENARIO", help=f"Scenarios to run, all by default: {', '.join(SCENARIOS)}"
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the content sizes of the scenarios")
+    parser.add_argument("--repeat", type=int, default=1, help="Run every scenario this many times, keep the best")
+    parser.add_argument("--args", default="", help='Extra options for FunKiiU, e.g. "--jobs 8 --segments 1"')
+    parser.add_argument("--save", metavar="FILE", help="Save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare with results saved by --save")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="How much slower than --compare a scenario may get"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the end of the FunKiiU output of failed runs")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        runs = [run(name, SCENARIOS[name], args) for _ in range(max(1, args.repeat))]
+        results.append(min(runs, key=lambda result: (not result.ok, result.wall)))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        for name, previous in list(baseline.items()):
+            if previous.get("settings") != settings(args):
+                print(f"{name} was saved with other settings, not comparing it: {previous.get('settings')}")
+                del baseline[name]
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    result.scenario: {**result._asdict(), "speed": result.speed, "settings": settings(args)}
+                    for result in results
+                },
+                f,
+                indent=2,
+            )
+
+    found = regressions(results, baseline or {}, args.tolerance)
+    for problem in found:
+        print(f"REGRESSION: {problem}", file=sys.stderr)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""Compares the download read loop against the one it replaced, without any network.
+
+Both loops copy an in-memory response into /dev/null and draw their progress to /dev/null
+as if stdout was a terminal.
+
+Usage: python3 benchmarks/bench_read_loop.py [SIZE_MB]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import FunKiiU  # noqa: E402
+
+
+def old_bytes2human(n: int, f: str = "%(value).2f %(symbol)s") -> str:
+    n = int(n)
+    prefix = {}
+    for i, s in enumerate(FunKiiU.SIZE_UNITS[1:]):
+        prefix[s] = 1 << (i + 1) * 10
+    for symbol in reversed(FunKiiU.SIZE_UNITS[1:]):
+        if n >= prefix[symbol]:
+            value = float(n) / prefix[symbol]
+            return f % locals()
+    return f % dict(symbol=FunKiiU.SIZE_UNITS[0], value=n)
+
+
+def old_progress_bar(part: int, total: int, length: int = 10) -> str:
+    percent = int((float(part) / float(total) * 100) % 100)
+    bar_len = int((float(part) / float(total) * length) % length)
+    bar = "#" * bar_len + " " * (length - bar_len)
+    return f"[{bar}] {old_bytes2human(part)} of {old_bytes2human(total)}, {percent}%" + " " * 20
+
+
+def old_loop(infile: io.BytesIO, outfile: io.BufferedWriter, expected_size: int, chunk_size: int = 2**16) -> int:
+    # the loop of download_file before copy_stream
+    downloaded_size = 0
+    while True:
+        buf = infile.read(chunk_size)
+        if not buf:
+            break
+        downloaded_size += len(buf)
+        if expected_size and len(buf) == chunk_size:
+            print(f" Downloaded {old_progress_bar(downloaded_size, expected_size)}", end="\r")
+        outfile.write(buf)
+    return downloaded_size
+
+
+def new_loop(infile: io.BytesIO, outfile: io.BufferedWriter, expected_size: int, chunk_size: int = 2**16) -> int:
+    FunKiiU.PROGRESS.start("bench", expected_size)
+    try:
+        return FunKiiU.copy_stream(infile, outfile, "bench", True, chunk_size)
+    finally:
+        FunKiiU.PROGRESS.finish("bench")
+
+
+def main() -> None:
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 256 * 2**20
+    data = os.urandom(2**20) * (size // 2**20)
+    FunKiiU.PROGRESS.enabled = True
+    for name, loop in (("old", old_loop), ("new", new_loop)):
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            with open(os.devnull, "wb") as outfile:
+                wall, cpu = time.perf_counter(), time.process_time()
+                copied = loop(io.BytesIO(data), outfile, len(data))
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        assert copied == len(data)
+        print(f"{name}: {len(data) / 2**20 / wall:8.1f} MB/s, {cpu / (len(data) / 2**30):6.2f} CPU s per GB")
+
+
+if __name__ == "__main__":
+    main()
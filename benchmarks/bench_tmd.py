@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+"""Compares the TMD model against the slicing/hexlify parsing it replaced.
+
+Usage: python3 benchmarks/bench_tmd.py [CONTENT_COUNT]
+"""
+
+import binascii
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from FunKiiU import TK, TMD, TMD_CONTENT_RECORD, TMD_CONTENTS_OFFSET  # noqa: E402
+
+
+def make_tmd(content_count: int) -> bytes:
+    header = bytearray(TMD_CONTENTS_OFFSET)
+    struct.pack_into(">HH", header, TK + 0x9C, 1, content_count)
+    records = b"".join(
+        TMD_CONTENT_RECORD.pack(i.to_bytes(4, "big"), i, 0x2003, 0x10000 * (i + 1), bytes(20))
+        for i in range(content_count)
+    )
+    return bytes(header) + records
+
+
+def parse_slicing(tmd: bytes) -> int:
+    # the parsing done by process_title_id before the TMD model: one pass to size, one to download
+    content_count = int(binascii.hexlify(tmd[TK + 0x9E : TK + 0xA0]), 16)
+    total_size = 0
+    for i in range(content_count):
+        c_offs = 0xB04 + (0x30 * i)
+        total_size += int(binascii.hexlify(tmd[c_offs + 0x08 : c_offs + 0x10]), 16)
+    for i in range(content_count):
+        c_offs = 0xB04 + (0x30 * i)
+        binascii.hexlify(tmd[c_offs : c_offs + 0x04]).decode()
+        int(binascii.hexlify(tmd[c_offs + 0x06 : c_offs + 0x08]), 16)
+        int(binascii.hexlify(tmd[c_offs + 0x08 : c_offs + 0x10]), 16)
+        tmd[c_offs + 0x10 : c_offs + 0x24]
+    return total_size
+
+
+def parse_model(tmd: bytes) -> int:
+    parsed = TMD(tmd)
+    for content in parsed.contents:
+        content.id, content.type, content.size, content.h3_hash
+    return parsed.total_size
+
+
+def main() -> None:
+    content_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    tmd = make_tmd(content_count)
+    assert parse_slicing(tmd) == parse_model(tmd)
+    for name, func in (("slicing", parse_slicing), ("model", parse_model)):
+        number, _ = timeit.Timer(lambda: func(tmd)).autorange()
+        best = min(timeit.repeat(lambda: func(tmd), number=number, repeat=5)) / number
+        print(f"{name:8} {content_count} contents: {best * 1e6:9.1f} us per TMD")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+"""A local stand-in for the CDN and the keysite, serving synthetic titles from memory.
+
+The same port answers like the CDN (`/ccs/download/<title id>/tmd`, `cetk`, `<content id>` and
+`<content id>.h3`) and like a keysite (`/json` and `/ticket/<title id>.tik`), so FunKiiU can be
+pointed at it with `--cdn http://127.0.0.1:PORT/ccs/download --keysite http://127.0.0.1:PORT`.
+
+Contents are generated on the fly, so huge titles don't need the memory they claim. Latency,
+a bandwidth cap, random error statuses and connections dropped in the middle of a content can
+be injected to see how the downloader copes with a slow or unreliable server.
+
+Usage: python3 benchmarks/fakecdn.py [--port PORT] [--titles N] [--contents N] [--size SIZE] [fault options]
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import FunKiiU  # noqa: E402
+
+BLOCK_SIZE = 2**20
+WRITE_SIZE = 2**16
+TITLE_KEY = "00112233445566778899aabbccddeeff"
+RE_CDN_PATH = re.compile(r"^/ccs/download/([0-9a-f]{16})/(tmd|cetk|[0-9a-f]{8}(?:\.h3)?)$")
+RE_TICKET_PATH = re.compile(r"^/ticket/([0-9a-f]{16})\.tik$")
+RE_RANGE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+class Faults(NamedTuple):
+    latency: float = 0.0  # seconds before every response
+    rate: int = 0  # bytes per second per connection, 0 for no limit
+    error_rate: float = 0.0  # chance a CDN request is answered with `error_status`
+    error_status: int = 404
+    disconnect_rate: float = 0.0  # chance a content connection is dropped halfway through its body
+    reset_rate: float = 0.0  # chance a content connection is reset halfway through its body, failing the read
+    seed: int = 0
+
+
+class Content:
+    """A synthetic content file: a pseudo-random block repeated up to `size` bytes."""
+
+    def __init__(self, title_id: str, index: int, size: int, hashed: bool = True) -> None:
+        self.id = f"{index:08x}"
+        self.index = index
+        self.size = size
+        self.hashed = hashed
+        self.block = random.Random(title_id + self.id).randbytes(min(size, BLOCK_SIZE))
+        # the .h3 file only has to match the TMD, nothing checks it against the content
+        self.h3 = hashlib.sha1(self.block).digest() * max(1, size // (BLOCK_SIZE * 16))
+
+    def record(self) -> bytes:
+        content_type = 0x2003 if self.hashed else 0x2001
+        content_hash = hashlib.sha1(self.h3).digest() if self.hashed else bytes(20)
+        return FunKiiU.TMD_CONTENT_RECORD.pack(
+            bytes.fromhex(self.id), self.index, content_type, self.size, content_hash
+        )
+
+    def chunks(self, start: int, end: int) -> Iterator[memoryview]:
+        """The bytes from `start` up to, not including, `end`."""
+        view = memoryview(self.block)
+        while start < end:
+            offset = start % len(self.block)
+            length = min(len(self.block) - offset, end - start, WRITE_SIZE)
+            yield view[offset : offset + length]
+            start += length
+
+
+class Title:
+    def __init__(self, title_id: str, sizes: List[int], name: str, region: str = "EUR", version: int = 32) -> None:
+        self.id = title_id
+        self.version = version
+        self.name = name
+        self.region = region
+        self.contents = {content.id: content for content in (Content(title_id, i, s) for i, s in enumerate(sizes))}
+        tmd = bytearray(FunKiiU.TMD_CONTENTS_OFFSET)
+        struct.pack_into(">I", tmd, 0, 0x00010004)
+        tmd[FunKiiU.TK + 0x4C : FunKiiU.TK + 0x54] = bytes.fromhex(title_id)
+        struct.pack_into(">HH", tmd, FunKiiU.TK + 0x9C, version, len(sizes))
+        self.tmd = bytes(tmd) + b"".join(content.record() for content in self.contents.values()) + bytes(0x700)
+
+    @property
+    def size(self) -> int:
+        return sum(content.size for content in self.contents.values())
+
+    def keysite_entry(self) -> Dict[str, str]:
+        return {"titleID": self.id, "titleKey": TITLE_KEY, "name": self.name, "region": self.region, "ticket": "1"}
+
+
+def make_titles(count: int, contents: int, size: int, region: str = "EUR") -> List[Title]:
+    """`count` games of `contents` contents of `size` bytes each."""
+    return [Title(f"00050000{0x10100000 + i:08x}", [size] * contents, f"Bench {i}", region) for i in range(count)]
+
+
+class FakeCDN(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], titles: List[Title], faults: Faults = Faults()) -> None:
+        super().__init__(address, Handler)
+        self.host = address[0]
+        self.titles = {title.id: title for title in titles}
+        self.keysite_json = json.dumps([title.keysite_entry() for title in titles]).encode()
+        self.faults = faults
+        self.random = random.Random(faults.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.injected_errors = 0
+        self.injected_disconnects = 0
+        self.injected_resets = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.server_address[1]}"
+
+    def chance(self, probability: float) -> bool:
+        if probability <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < probability
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, Nagle would hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+    server: FakeCDN
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format: str, *args) -> None:  # noqa: A002 # same name as the base class
+        pass
+
+    def do_GET(self) -> None:
+        faults = self.server.faults
+        with self.server.lock:
+            self.server.requests += 1
+        if faults.latency:
+            time.sleep(faults.latency)
+
+        path = urlsplit(self.path).path
+        if path == "/json":
+            return self.send_bytes(self.server.keysite_json)
+        match = RE_TICKET_PATH.match(path)
+        if match:
+            title = self.server.titles.get(match.group(1))
+            return self.send_bytes(ticket(title)) if title else self.send_bytes(b"Not found", 404)
+
+        match = RE_CDN_PATH.match(path)
+        title = match and self.server.titles.get(match.group(1))
+        if not match or not title:
+            return self.send_bytes(b"Not found", 404)
+        if self.server.chance(faults.error_rate):
+            with self.server.lock:
+                self.server.injected_errors += 1
+            return self.send_bytes(b"Injected error", faults.error_status)
+
+        name = match.group(2)
+        if name == "tmd":
+            return self.send_bytes(title.tmd)
+        if name == "cetk":
+            return self.send_bytes(ticket(title))
+        content = title.contents.get(name[:8])
+        if not content or (name.endswith(".h3") and not content.hashed):
+            return self.send_bytes(b"Not found", 404)
+        if name.endswith(".h3"):
+            return self.send_bytes(content.h3)
+        return self.send_content(content)
+
+    def send_bytes(self, data: bytes, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.write(iter([memoryview(data)]))
+
+    def send_content(self, content: Content) -> None:
+        start, end = 0, content.size
+        match = RE_RANGE.match(self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, content.size) if match.group(2) else content.size
+            if start >= content.size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{content.size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Length", str(end - start))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{content.size}")
+        self.end_headers()
+
+        cut: Optional[int] = None
+        reset = False
+        if end - start > 1 and self.server.chance(self.server.faults.disconnect_rate):
+            cut = start + (end - start) // 2
+            with self.server.lock:
+                self.server.injected_disconnects += 1
+        elif end - start > 1 and self.server.chance(self.server.faults.reset_rate):
+            cut = start + (end - start) // 2
+            reset = True
+            with self.server.lock:
+                self.server.injected_resets += 1
+        self.write(content.chunks(start, end if cut is None else cut))
+        if cut is not None:
+            self.wfile.flush()
+            if reset:
+                # closing with a zero linger time sends a RST, the client's read fails instead of ending
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.connection.close()
+            else:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+
+    def write(self, chunks: Iterator[memoryview]) -> None:
+        rate = self.server.faults.rate
+        started = time.monotonic()
+        sent = 0
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    delay = sent / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def ticket(title: Title) -> bytes:
+    """A ticket like the ones FunKiiU makes, so downloaded titles pass `--verify`."""
+    return FunKiiU.ticket_data(title.id, TITLE_KEY, struct.pack(">H", title.version))
+
+
+def parse_faults(args) -> Faults:
+    return Faults(
+        latency=args.latency,
+        rate=args.rate,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        disconnect_rate=args.disconnect_rate,
+        reset_rate=args.reset_rate,
+        seed=args.seed,
+    )
+
+
+def add_fault_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every response")
+    parser.add_argument(
+        "--rate", type=FunKiiU.human2bytes, default=0, help="Bytes per second per connection (e.g. 10M), 0 for no limit"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Chance a CDN request fails with --error-status")
+    parser.add_argument("--error-status", type=int, default=404, help="Status of the injected errors")
+    parser.add_argument(
+        "--disconnect-rate", type=float, default=0.0, help="Chance a content connection is dropped halfway through"
+    )
+    parser.add_argument(
+        "--reset-rate", type=float, default=0.0, help="Chance a content connection is reset halfway through"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected faults")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Local stand-in for the CDN and the keysite")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--titles", type=int, default=4, help="How many titles to serve")
+    parser.add_argument("--contents", type=int, default=4, help="How many contents every title has")
+    parser.add_argument("--size", type=FunKiiU.human2bytes, default=2**20, help="Size of every content (e.g. 64M)")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeCDN((args.host, args.port), make_titles(args.titles, args.contents, args.size), parse_faults(args))
+    print(f"Serving {len(server.titles)} titles on {server.url}")
+    print(f"  --cdn {server.url}/ccs/download --keysite {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -4,9 +4,10 @@ set -eux
 
 MY_DIR="$(dirname "$(readlink -f "$0")")"
 
-for TITLE in "$@"; do
-    poetry run python "$MY_DIR/FunKiiU.py" --titles "$TITLE" --keysite http://127.0.0.1:8000 --online-tickets \
-    || poetry run python "$MY_DIR/FunKiiU.py" --titles "$TITLE" --keysite http://127.0.0.1:8000 --online-keys
-done
+# titles whose ticket can't be downloaded get one made from their title key;
+# set FUNKIIU_DAEMON to the URL of a `FunKiiU.py --serve` daemon to run the batch there
+poetry run python "$MY_DIR/FunKiiU.py" --titles "$@" --keysite http://127.0.0.1:8000 --online-tickets --fallback-keys \
+    ${FUNKIIU_DAEMON:+--submit "$FUNKIIU_DAEMON"}
 
 # rsync -av --checksum install/ /media/nuno/TIRA/install/
+# or, without the copy, download straight to the card with: --out-dir /media/nuno/TIRA/install --fsync